@@ -0,0 +1,313 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from botocore.exceptions import ClientError
+
+RUN_STATES = ['SUCCEEDED', 'SUCCEEDED', 'SUCCEEDED', 'FAILED', 'RUNNING', 'STOPPED']
+WORKER_TYPES = ['G.1X', 'G.2X', 'Standard']
+
+
+class CallCounter:
+    # API calls per "service.operation", shared by all fakes of one case
+
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, operation):
+        with self.lock:
+            self.counts[operation] += 1
+
+    def by_service(self):
+        services = Counter()
+        for operation, count in self.counts.items():
+            services[operation.split('.')[0]] += count
+        return dict(services)
+
+
+class FakeGlue:
+    # Glue with `jobs` jobs of `runs_per_job` runs each, newest first and
+    # spaced evenly over `history_hours`. Runs are generated per page, so
+    # 20k jobs don't need to sit in memory. A fraction of calls can be made
+    # to fail with ThrottlingException.
+
+    class exceptions:
+        class EntityNotFoundException(Exception):
+            pass
+
+    def __init__(self, calls, jobs, runs_per_job, history_hours=24, throttle_rate=0.0, latency_ms=0, seed=1):
+        self.calls = calls
+        self.jobs = jobs
+        self.runs_per_job = runs_per_job
+        self.spacing = timedelta(hours=history_hours) / max(1, runs_per_job)
+        self.throttle_rate = throttle_rate
+        self.latency = latency_ms / 1000
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.now = datetime.now(timezone.utc)
+
+    def _call(self, operation):
+        self.calls.add(f"glue.{operation}")
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_rate:
+            with self.random_lock:
+                throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.calls.add("glue.Throttled")
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+    def job_name(self, index):
+        return f"job-{index:06d}"
+
+    def _page(self, next_token, max_results, total):
+        start = int(next_token or 0)
+        end = min(total, start + max_results)
+        return start, end, (str(end) if end < total else None)
+
+    def _run(self, job_index, run_index):
+        state = RUN_STATES[(job_index + run_index) % len(RUN_STATES)]
+        execution_time = 60 + (job_index * 7 + run_index * 13) % 3600
+        run = {
+            'Id': f"jr_{job_index:06d}_{run_index:06d}",
+            'JobName': self.job_name(job_index),
+            'JobRunState': state,
+            'StartedOn': self.now - self.spacing * run_index - timedelta(seconds=job_index % 60),
+            'ExecutionTime': execution_time,
+            'WorkerType': WORKER_TYPES[job_index % len(WORKER_TYPES)],
+            'AllocatedCapacity': 2 + job_index % 10,
+            'GlueVersion': '4.0',
+        }
+        if state != 'RUNNING':
+            run['CompletedOn'] = run['StartedOn'] + timedelta(seconds=execution_time)
+            run['DPUSeconds'] = float(execution_time * run['AllocatedCapacity'])
+        return run
+
+    def get_jobs(self, NextToken=None, MaxResults=100):
+        self._call('GetJobs')
+        start, end, token = self._page(NextToken, MaxResults, self.jobs)
+        response = {'Jobs': [{'Name': self.job_name(i), 'Command': {'Name': 'glueetl'}} for i in range(start, end)]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def list_jobs(self, NextToken=None, MaxResults=1000):
+        self._call('ListJobs')
+        start, end, token = self._page(NextToken, MaxResults, self.jobs)
+        response = {'JobNames': [self.job_name(i) for i in range(start, end)]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def get_job_runs(self, JobName, NextToken=None, MaxResults=100):
+        self._call('GetJobRuns')
+        job_index = int(JobName.rsplit('-', 1)[1])
+        start, end, token = self._page(NextToken, MaxResults, self.runs_per_job)
+        response = {'JobRuns': [self._run(job_index, i) for i in range(start, end)]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def get_job_run(self, JobName, RunId, **kwargs):
+        self._call('GetJobRun')
+        job_index, run_index = (int(part) for part in RunId.split('_')[1:])
+        return {'JobRun': self._run(job_index, run_index)}
+
+
+def glue_state_change_batch(glue, hours=2, duplicate_every=10):
+    # An SQS batch of EventBridge "Glue Job State Change" events for every
+    # FakeGlue run started in the last `hours`, with every
+    # `duplicate_every`th message delivered twice
+    records = []
+    recent_runs = min(glue.runs_per_job, int(timedelta(hours=hours) / glue.spacing) + 1)
+    for job_index in range(glue.jobs):
+        for run_index in range(recent_runs):
+            run = glue._run(job_index, run_index)
+            body = {
+                'version': '0',
+                'id': f"event-{job_index}-{run_index}",
+                'detail-type': 'Glue Job State Change',
+                'source': 'aws.glue',
+                'time': run['StartedOn'].isoformat(),
+                'region': 'ap-southeast-2',
+                'resources': [],
+                'detail': {
+                    'jobName': run['JobName'],
+                    'severity': 'INFO' if run['JobRunState'] == 'SUCCEEDED' else 'ERROR',
+                    'state': run['JobRunState'],
+                    'jobRunId': run['Id'],
+                    'message': f"Job run {run['JobRunState'].lower()}",
+                },
+            }
+            record = {
+                'messageId': f"msg-{len(records)}",
+                'receiptHandle': 'fake',
+                'body': json.dumps(body),
+                'attributes': {},
+                'messageAttributes': {},
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': 'arn:aws:sqs:ap-southeast-2:000000000000:glue-job-state-change',
+                'awsRegion': 'ap-southeast-2',
+            }
+            records.append(record)
+            if duplicate_every and len(records) % duplicate_every == 0:
+                records.append(dict(record, messageId=f"msg-{len(records)}"))
+    return {'Records': records}
+
+
+class FakeCloudWatch:
+    # Records every put_metric_data call
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.datapoints = 0
+        self.lock = threading.Lock()
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.calls.add('cloudwatch.PutMetricData')
+        with self.lock:
+            self.datapoints += len(MetricData)
+        return {}
+
+
+class FakeMwaa:
+    # create_web_login_token pointing at the local fake Airflow web server
+
+    def __init__(self, calls, host):
+        self.calls = calls
+        self.host = host
+
+    def create_web_login_token(self, Name):
+        self.calls.add('mwaa.CreateWebLoginToken')
+        return {'WebServerHostname': self.host, 'WebToken': f"token-{Name}"}
+
+
+class FakeAirflowServer:
+    # Local MWAA login plus the Airflow REST endpoints the lambda uses, with
+    # `dags` DAGs of `runs_per_dag` runs each, with `tasks_per_run` task
+    # instances per run. One server serves every environment; requests are
+    # counted as "airflow.<route>".
+
+    def __init__(self, calls, dags, runs_per_dag, paused_fraction=0.0, latency_ms=0, tasks_per_run=3):
+        self.calls = calls
+        self.dags = [{
+            'dag_id': f"dag_{i:05d}",
+            'is_paused': i < int(dags * paused_fraction),
+            'is_active': True,
+        } for i in range(dags)]
+        self.runs_per_dag = runs_per_dag
+        self.tasks_per_run = tasks_per_run
+        self.latency = latency_ms / 1000
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def runs_for(self, dag_id):
+        return [{
+            'dag_id': dag_id,
+            'dag_run_id': f"scheduled__{i}",
+            'execution_date': '2024-01-01T00:00:00+00:00',
+            'external_trigger': False,
+            'start_date': '2024-01-01T00:00:00+00:00',
+            'end_date': '2024-01-01T00:05:00+00:00',
+            'state': 'failed' if i % 5 == 4 else 'success',
+        } for i in range(self.runs_per_dag)]
+
+    def task_instances_for(self, dag_id):
+        return [{
+            'dag_id': dag_id,
+            'dag_run_id': run['dag_run_id'],
+            'task_id': f"task_{t}",
+            'state': run['state'],
+            'queued_when': '2024-01-01T00:00:00+00:00',
+            'start_date': f"2024-01-01T00:00:{(i + t) % 60:02d}+00:00",
+            'end_date': '2024-01-01T00:05:00+00:00',
+            'duration': 60.0 + 10 * t + i,
+        } for i, run in enumerate(self.runs_for(dag_id)) for t in range(self.tasks_per_run)]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=None, headers=()):
+                data = json.dumps(body if body is not None else {}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _route(self, route):
+                fake.calls.add(f"airflow.{route}")
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                path = urlsplit(self.path).path
+                if path == '/aws_mwaa/login':
+                    self._route('Login')
+                    return self._send(200, {}, [('Set-Cookie', 'session=fake-session; Path=/')])
+                if path == '/api/v1/dags/~/dagRuns/list':
+                    self._route('ListDagRunsBatch')
+                    request = json.loads(body)
+                    runs = [run for dag_id in request['dag_ids'] for run in fake.runs_for(dag_id)]
+                    offset = request.get('page_offset', 0)
+                    return self._send(200, {'dag_runs': runs[offset:offset + request.get('page_limit', 100)],
+                                            'total_entries': len(runs)})
+                if path == '/api/v1/dags/~/dagRuns/~/taskInstances/list':
+                    self._route('ListTaskInstancesBatch')
+                    request = json.loads(body)
+                    task_instances = [ti for dag_id in request['dag_ids'] for ti in fake.task_instances_for(dag_id)]
+                    offset = request.get('page_offset', 0)
+                    return self._send(200, {'task_instances': task_instances[offset:offset + request.get('page_limit', 100)],
+                                            'total_entries': len(task_instances)})
+                self._send(404)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = dict(parse_qsl(url.query))
+                offset = int(query.get('offset', 0))
+                limit = int(query.get('limit', 100))
+                parts = url.path.strip('/').split('/')
+
+                if url.path == '/api/v1/dags':
+                    self._route('ListDags')
+                    dags = fake.dags
+                    if query.get('paused') in ('true', 'false'):
+                        dags = [dag for dag in dags if dag['is_paused'] == (query['paused'] == 'true')]
+                    # The scheduler re-parses DAG files all the time, so
+                    # last_parsed_time moves on with every request
+                    parsed = datetime.now(timezone.utc).isoformat()
+                    page = [dict(dag, last_parsed_time=parsed) for dag in dags[offset:offset + limit]]
+                    return self._send(200, {'dags': page, 'total_entries': len(dags)})
+                if len(parts) == 5 and parts[:3] == ['api', 'v1', 'dags'] and parts[4] == 'dagRuns':
+                    self._route('ListDagRuns')
+                    runs = fake.runs_for(parts[3])
+                    return self._send(200, {'dag_runs': runs[offset:offset + limit], 'total_entries': len(runs)})
+                self._send(404)
+
+        return Handler
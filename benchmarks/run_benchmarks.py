@@ -0,0 +1,274 @@
+"""Offline benchmarks for the metric lambdas.
+
+Each case loads one lambda file in a fresh process with client creation
+patched to return in-process fakes (and, for Airflow, a local fake web server),
+calls its lambda_handler once and records wall time, API calls per service,
+peak RSS and datapoints published. import_seconds is the lambda module import
+with nothing preloaded; boto3 itself is imported when the first client is
+created, inside wall_seconds. Results are written as JSON so runs from
+different commits can be compared:
+
+    python benchmarks/run_benchmarks.py --sizes 100,2000,20000
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<commit>.json
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+GLUE_LAMBDAS = [
+    'prod-glue-custom-metrics-lambda.py',
+    'prod-glue-job-running-metrics-lambda.py',
+    'glue-dpu-custom-metrics-lambda.py',
+    'prod-glue-combined-metrics-lambda.py',
+]
+EVENTS_LAMBDA = 'prod-glue-combined-metrics-lambda.py'  # Also run in GLUE_COLLECT_MODE=events
+AIRFLOW_LAMBDAS = [
+    'prod-airflow-custom-metrics-status-lambda.py',
+]
+
+
+class FakeContext:
+    # The bits of the Lambda context object the handlers may use
+
+    function_name = 'benchmark'
+    aws_request_id = 'benchmark'
+
+    def __init__(self, timeout_ms):
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def load_lambda(path):
+    spec = importlib.util.spec_from_file_location(os.path.basename(path).replace('-', '_')[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_case(case, results):
+    # Runs in a child process so peak RSS and module state are per case
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    from fakes import CallCounter, FakeAirflowServer, FakeCloudWatch, FakeGlue, FakeMwaa, glue_state_change_batch
+
+    logging.disable(logging.WARNING)
+    os.environ.update(case['env'])
+    calls = CallCounter()
+    cloudwatch = FakeCloudWatch(calls)
+    clients = {'cloudwatch': cloudwatch}
+    server = None
+
+    if case['kind'] in ('glue', 'glue-events'):
+        clients['glue'] = FakeGlue(calls, case['size'], case['runs_per_job'], throttle_rate=case['throttle_rate'],
+                                   latency_ms=case['latency_ms'])
+    else:
+        server = FakeAirflowServer(calls, case['size'] // case['environments'], case['runs_per_dag'],
+                                   paused_fraction=case['paused_fraction'], latency_ms=case['latency_ms']).start()
+        clients['mwaa'] = FakeMwaa(calls, server.host)
+        os.environ['ENV_NAMES'] = json.dumps([f"env-{i}" for i in range(case['environments'])])
+        os.environ['MWAA_WEB_SCHEME'] = 'http'
+
+    def create_client(service, *args, **kwargs):
+        import boto3  # Charge the real boto3 import to the case, as in a cold start
+        return clients[service]
+
+    if os.path.exists(os.path.join(REPO_DIR, 'bootstrap.py')):
+        # Patched without importing boto3, so import_seconds is the lambda's own
+        import bootstrap
+        bootstrap.create_client = create_client
+    else:
+        import boto3
+        boto3.client = create_client
+
+    stdout = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(stdout):
+            import_start = time.perf_counter()
+            module = load_lambda(os.path.join(REPO_DIR, case['lambda']))
+            import_seconds = time.perf_counter() - import_start
+
+            events = glue_state_change_batch(clients['glue']) if case['kind'] == 'glue-events' else None
+            start = time.perf_counter()
+            if events is not None:
+                # Record the event batch, then publish from it on the tick
+                module.lambda_handler(events, FakeContext(case['timeout_ms']))
+            module.lambda_handler({}, FakeContext(case['timeout_ms']))
+            wall_seconds = time.perf_counter() - start
+        error = None
+    except Exception as e:
+        import_seconds = wall_seconds = None
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        if server is not None:
+            server.stop()
+
+    results.put(dict(
+        case,
+        import_seconds=import_seconds,
+        wall_seconds=wall_seconds,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # ru_maxrss is KiB on Linux
+        api_calls=calls.by_service(),
+        api_calls_by_operation=dict(calls.counts),
+        datapoints=cloudwatch.datapoints,
+        emf_lines=sum(1 for line in stdout.getvalue().splitlines() if line.startswith('{"_aws"')),
+        error=error,
+    ))
+
+
+def run_in_child(case, timeout_seconds):
+    # A child that crashes (killed for memory, a native fault) or hangs never
+    # puts a result, so poll for it and record the case as failed instead
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_case, args=(case, results))
+    process.start()
+    deadline = time.monotonic() + timeout_seconds
+    error = None
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            try:
+                result = results.get(timeout=1)  # Put just before it exited
+                break
+            except queue.Empty:
+                error = f"Benchmark process exited with code {process.exitcode} without a result"
+                break
+        if time.monotonic() > deadline:
+            process.kill()
+            error = f"Benchmark process did not finish in {timeout_seconds}s"
+            break
+    process.join()
+    if error is not None:
+        result = dict(case, import_seconds=None, wall_seconds=None, peak_rss_mb=None, api_calls={},
+                      api_calls_by_operation={}, datapoints=0, emf_lines=0, error=error)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def build_cases(args):
+    env = {
+        'METRICS_SINK': args.sink,
+        'GLUE_REQUESTS_PER_SECOND': str(args.glue_rps),
+    }
+    cases = []
+    for size in args.sizes:
+        if args.only in (None, 'glue'):
+            for name in GLUE_LAMBDAS:
+                cases.append({
+                    'lambda': name, 'kind': 'glue', 'size': size, 'runs_per_job': args.runs_per_job,
+                    'throttle_rate': args.throttle_rate, 'latency_ms': args.latency_ms,
+                    'timeout_ms': args.timeout_ms, 'env': env,
+                })
+        if args.only in (None, 'glue', 'events'):
+            cases.append({
+                'lambda': EVENTS_LAMBDA, 'kind': 'glue-events', 'size': size, 'runs_per_job': args.runs_per_job,
+                'throttle_rate': args.throttle_rate, 'latency_ms': args.latency_ms,
+                'timeout_ms': args.timeout_ms, 'env': dict(env, GLUE_COLLECT_MODE='events', GLUE_STATE_STORE='sqlite://:memory:'),
+            })
+        if args.only in (None, 'airflow'):
+            for name in AIRFLOW_LAMBDAS:
+                cases.append({
+                    'lambda': name, 'kind': 'airflow', 'size': size, 'environments': args.environments,
+                    'runs_per_dag': args.runs_per_dag, 'paused_fraction': args.paused_fraction,
+                    'latency_ms': args.latency_ms, 'timeout_ms': args.timeout_ms, 'env': env,
+                })
+    return cases
+
+
+def case_key(case):
+    mode = '[events]' if case['kind'] == 'glue-events' else ''
+    return f"{case['lambda']}{mode}@{case['size']}"
+
+
+def print_results(results, baseline=None):
+    baseline = {case_key(case): case for case in (baseline or {}).get('cases', [])}
+    print(f"{'case':58} {'wall s':>9} {'import s':>9} {'calls':>8} {'rss MB':>8} {'points':>8}")
+    for case in results['cases']:
+        if case['error']:
+            print(f"{case_key(case):58} ERROR {case['error']}")
+            continue
+        calls = sum(case['api_calls'].values())
+        line = (f"{case_key(case):58} {case['wall_seconds']:9.3f} {case['import_seconds']:9.3f} {calls:8d} "
+                f"{case['peak_rss_mb']:8.1f} {case['datapoints']:8d}")
+        before = baseline.get(case_key(case))
+        if before and not before['error']:
+            line += (f"   wall x{case['wall_seconds'] / max(before['wall_seconds'], 1e-9):.2f}"
+                     f" calls {sum(before['api_calls'].values())}->{calls}")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,2000,20000',
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help='Glue jobs, or Airflow DAGs across all environments, per case')
+    parser.add_argument('--only', choices=['glue', 'events', 'airflow'],
+                        help='Run only the Glue, the Glue event-driven or the Airflow cases')
+    parser.add_argument('--runs-per-job', type=int, default=48, help='Glue runs per job over the last 24 hours')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of Glue calls that throttle')
+    parser.add_argument('--environments', type=int, default=3, help='MWAA environments')
+    parser.add_argument('--runs-per-dag', type=int, default=2, help='Airflow runs per DAG in the window')
+    parser.add_argument('--paused-fraction', type=float, default=0.2, help='Fraction of paused DAGs')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Added latency per fake API call')
+    parser.add_argument('--glue-rps', type=float, default=100000, help='GLUE_REQUESTS_PER_SECOND for the run')
+    parser.add_argument('--sink', default='cloudwatch', choices=['cloudwatch', 'emf'], help='METRICS_SINK')
+    parser.add_argument('--timeout-ms', type=int, default=900000, help='Lambda timeout the context reports')
+    parser.add_argument('--case-timeout', type=float, default=3600,
+                        help='Seconds a case may run before it is killed and recorded as an error')
+    parser.add_argument('--output', help='Result file (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='Earlier result file to compare against')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'cases': [],
+    }
+    for case in build_cases(args):
+        results['cases'].append(run_in_child(case, args.case_timeout))
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', f"{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
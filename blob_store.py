@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger()
+
+
+class LocalBlobStore:
+    # JSON documents as files under a directory
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def get_json(self, key):
+        try:
+            with open(self._file(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put_json(self, key, value):
+        path = self._file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(value, f)
+        os.replace(path + '.tmp', path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3BlobStore:
+    # JSON documents as objects under an S3 (or S3 compatible) prefix. The
+    # endpoint can be pointed elsewhere with AWS_ENDPOINT_URL_S3.
+
+    def __init__(self, bucket, prefix, s3_client=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.s3_client = s3_client
+
+    def _client(self):
+        if self.s3_client is None:
+            from bootstrap import get_client
+            self.s3_client = get_client('s3')
+        return self.s3_client
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def get_json(self, key):
+        client = self._client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    def put_json(self, key, value):
+        self._client().put_object(Bucket=self.bucket, Key=self._key(key), Body=json.dumps(value).encode(),
+                                  ContentType='application/json')
+
+    def delete(self, key):
+        self._client().delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def open_blob_store(uri):
+    # s3://bucket/prefix, or a local directory path. None or '' means no store.
+    if not uri:
+        return None
+    if uri.startswith('s3://'):
+        bucket, _, prefix = uri[len('s3://'):].partition('/')
+        return S3BlobStore(bucket, prefix)
+    if uri.startswith('file://'):
+        uri = uri[len('file://'):]
+    return LocalBlobStore(uri)
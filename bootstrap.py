@@ -0,0 +1,79 @@
+import os
+import threading
+
+from instrumentation import instrument_client
+
+# botocore settings shared by every client. The pool is sized for the Glue
+# fetcher's worker threads plus the parallel put_metric_data flush.
+MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '32'))
+RETRY_MODE = os.getenv('AWS_RETRY_MODE', 'adaptive')
+MAX_ATTEMPTS = int(os.getenv('AWS_MAX_ATTEMPTS', '3'))
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+# Glue calls are rate limited and retried by glue_fetcher's ThrottledClient;
+# SDK retries underneath it would multiply the attempts of every call
+SERVICE_RETRIES = {'glue': {'mode': 'standard', 'total_max_attempts': 1}}
+
+_clients = {}
+_clients_lock = threading.Lock()
+_configs = {}
+
+
+def client_config(service=None):
+    # Built on first use so importing this module doesn't import botocore
+    retries = SERVICE_RETRIES.get(service, {'mode': RETRY_MODE, 'max_attempts': MAX_ATTEMPTS})
+    key = tuple(sorted(retries.items()))
+    if key not in _configs:
+        from botocore.config import Config
+        _configs[key] = Config(
+            max_pool_connections=MAX_POOL_CONNECTIONS,
+            retries=retries,
+            tcp_keepalive=True,
+            connect_timeout=CONNECT_TIMEOUT,
+            read_timeout=READ_TIMEOUT,
+        )
+    return _configs[key]
+
+
+def create_client(service, region_name=None):
+    import boto3
+    kwargs = {'config': client_config(service)}
+    if region_name:
+        kwargs['region_name'] = region_name
+    return boto3.client(service, **kwargs)
+
+
+def get_client(service, region_name=None):
+    # One instrumented client per (service, region), created on first use and
+    # kept across warm invocations
+    key = (service, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = instrument_client(create_client(service, region_name), service)
+    return client
+
+
+def reset_clients():
+    # Forget cached clients, e.g. in a forked process that must not share
+    # the parent's connections
+    with _clients_lock:
+        _clients.clear()
+
+
+class LazyClient:
+    # Stands in for a client at module level; boto3 is only imported and the
+    # client only created when the first call is made
+
+    def __init__(self, service, region_name=None):
+        self._service = service
+        self._region_name = region_name
+
+    def __getattr__(self, name):
+        return getattr(get_client(self._service, self._region_name), name)
+
+
+def lazy_client(service, region_name=None):
+    return LazyClient(service, region_name)
@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger()
+
+# Time kept back from the Lambda timeout to publish what has been collected
+# and hand the rest on
+DEADLINE_MARGIN_MS = int(os.getenv('DEADLINE_MARGIN_MS', '30000'))
+# Unfinished work is passed to an async invocation of the same function; set
+# to false to leave it in the store for the next scheduled tick instead
+REINVOKE = os.getenv('CONTINUATION_REINVOKE', 'true').lower() == 'true'
+MAX_CONTINUATIONS = int(os.getenv('MAX_CONTINUATIONS', '10'))  # Invocations one collection may span
+
+
+class Deadline:
+    # When the invocation has to stop collecting, from the Lambda context.
+    # Without a context (local runs) it never expires.
+
+    def __init__(self, context=None, margin_ms=DEADLINE_MARGIN_MS):
+        self.context = context
+        self.margin_ms = margin_ms
+
+    def remaining_ms(self):
+        if self.context is None or not hasattr(self.context, 'get_remaining_time_in_millis'):
+            return float('inf')
+        return self.context.get_remaining_time_in_millis()
+
+    def expired(self):
+        return self.remaining_ms() < self.margin_ms
+
+
+def hand_off(context, payload, save=None):
+    # Continue unfinished work elsewhere: re-invoke this function with the
+    # payload, or else save it for the next tick. Returns how it was handed on.
+    function_name = getattr(context, 'function_name', None)
+    if REINVOKE and function_name:
+        try:
+            from bootstrap import get_client
+            get_client('lambda').invoke(FunctionName=function_name, InvocationType='Event',
+                                        Payload=json.dumps(payload).encode())
+            logger.info(f"Re-invoked {function_name} to continue collection.")
+            return 'reinvoked'
+        except Exception as e:
+            logger.error(f"Failed to re-invoke {function_name}: {str(e)}")
+
+    if save is not None:
+        save(payload)
+        logger.info("Saved the continuation for the next tick.")
+        return 'saved'
+
+    logger.error("Nowhere to hand the continuation to, the rest of this collection is dropped.")
+    return 'dropped'
@@ -0,0 +1,134 @@
+import logging
+import os
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from glue_collector import Aggregator, JobStatusCounts, list_job_names, scan, to_utc
+
+logger = logging.getLogger()
+
+# Jobs handled per invocation; the rest are picked up from the cursor
+BACKFILL_JOBS_PER_INVOCATION = int(os.getenv('BACKFILL_JOBS_PER_INVOCATION', '500'))
+DEFAULT_BUCKET_MINUTES = 60
+
+STATUSES = list(JobStatusCounts.STATUSES.items())  # [(Glue state, Status dimension)]
+STATUS_INDEX = {state: i for i, (state, _) in enumerate(STATUSES)}
+
+
+class BucketedStatusCounts(Aggregator):
+    # JobStatusCount for every bucket of a range in one pass. A run's bucket
+    # is (started_on - start) // width, and each job keeps one flat array of
+    # buckets x statuses, so adding a run is O(1) whatever the range.
+
+    def __init__(self, start_time, end_time, bucket_width):
+        super().__init__(start_time, end_time)
+        self.bucket_seconds = int(bucket_width.total_seconds())
+        self.buckets = -(-int((end_time - start_time).total_seconds()) // self.bucket_seconds)
+        self.start_epoch = start_time.timestamp()
+        self.job_counts = {}
+
+    def add_job(self, job_name):
+        if job_name not in self.job_counts:
+            self.job_counts[job_name] = array('I', bytes(4 * self.buckets * len(STATUSES)))
+
+    def add(self, run):
+        # Buckets are half-open, [start, start + width)
+        if self.start_time <= run.started_on < self.end_time:
+            self.add_run(run)
+
+    def add_run(self, run):
+        status = STATUS_INDEX.get(run.state)
+        if status is None:
+            return
+        bucket = int(run.started_on.timestamp() - self.start_epoch) // self.bucket_seconds
+        self.add_job(run.job_name)
+        self.job_counts[run.job_name][bucket * len(STATUSES) + status] += 1
+
+    def bucket_end(self, bucket):
+        return datetime.fromtimestamp(self.start_epoch + (bucket + 1) * self.bucket_seconds, timezone.utc)
+
+    def metric_data(self):
+        # Each bucket's counts are stamped with the bucket end, which is when
+        # the scheduled lambda would have published them
+        metric_data = []
+        timestamps = [self.bucket_end(bucket) for bucket in range(self.buckets)]
+        for job_name, counts in self.job_counts.items():
+            for bucket, timestamp in enumerate(timestamps):
+                for status, (_, dimension) in enumerate(STATUSES):
+                    metric_data.append({
+                        'MetricName': 'JobStatusCount',
+                        'Timestamp': timestamp,
+                        'Value': counts[bucket * len(STATUSES) + status],
+                        'Unit': 'Count',
+                        'Dimensions': [
+                            {'Name': 'JobName', 'Value': job_name},
+                            {'Name': 'Status', 'Value': dimension}
+                        ]
+                    })
+        return metric_data
+
+
+def align(dt, bucket_width):
+    # Round down to a multiple of the bucket width since the epoch
+    seconds = int(bucket_width.total_seconds())
+    return datetime.fromtimestamp(int(dt.timestamp()) // seconds * seconds, timezone.utc)
+
+
+def parse_request(request):
+    # {'start': ISO time, 'end': ISO time, 'bucket_minutes': 60}. Both ends
+    # are rounded down to the bucket width, so every bucket is whole and
+    # none is stamped after the requested end.
+    bucket_width = timedelta(minutes=int(request.get('bucket_minutes', DEFAULT_BUCKET_MINUTES)))
+    start_time = align(to_utc(datetime.fromisoformat(request['start'])), bucket_width)
+    end_time = align(to_utc(datetime.fromisoformat(request['end'])), bucket_width)
+    if end_time <= start_time:
+        raise ValueError(f"Backfill range {request['start']} to {request['end']} doesn't cover a whole "
+                         f"{bucket_width} bucket")
+    return start_time, end_time, bucket_width
+
+
+def cursor_key(start_time, end_time, bucket_width):
+    return f"backfill/{start_time.isoformat()}/{end_time.isoformat()}/{int(bucket_width.total_seconds())}"
+
+
+def backfill(glue_client, publisher, namespace, request, state_store=None, jobs_per_invocation=None):
+    # Publish JobStatusCount for every bucket of the requested range. Jobs
+    # are taken in name order, up to jobs_per_invocation at a time; the
+    # cursor (the last job done) is kept in the state store when there is
+    # one and returned either way, so the caller can invoke again with it
+    # until 'done' is true.
+    start_time, end_time, bucket_width = parse_request(request)
+    key = cursor_key(start_time, end_time, bucket_width)
+    jobs_per_invocation = jobs_per_invocation or BACKFILL_JOBS_PER_INVOCATION
+
+    cursor = request.get('cursor')
+    if cursor is None and state_store is not None:
+        cursor = state_store.get(key)
+    cursor = cursor or {'after_job': None, 'jobs_done': 0}
+
+    from glue_fetcher import GlueFetcher
+
+    fetcher = GlueFetcher(glue_client)
+    job_names = sorted(list_job_names(fetcher.client))
+    if cursor['after_job'] is not None:
+        job_names = [job_name for job_name in job_names if job_name > cursor['after_job']]
+    batch = job_names[:jobs_per_invocation]
+
+    counts = BucketedStatusCounts(start_time, end_time, bucket_width)
+    run_count = scan(glue_client, [counts], fetcher=fetcher, job_names=batch) if batch else 0
+
+    metric_data = counts.metric_data()
+    publisher.put(namespace, metric_data)
+    stats = publisher.flush()
+
+    cursor = {
+        'after_job': batch[-1] if batch else cursor['after_job'],
+        'jobs_done': cursor['jobs_done'] + len(batch),
+        'done': len(batch) == len(job_names),
+    }
+    if state_store is not None:
+        state_store.put(key, cursor)
+
+    logger.info(f"Backfilled {len(batch)} jobs, {run_count} runs into {counts.buckets} buckets "
+                f"from {start_time} to {end_time}; {len(job_names) - len(batch)} jobs left.")
+    return dict(stats, runs=run_count, buckets=counts.buckets, cursor=cursor, done=cursor['done'])
@@ -0,0 +1,508 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from glue_columns import RunColumns, grouped_stats
+from glue_cost import finished_run_costs, run_cost
+from run_export import EXPORT_URI, RecordWriter, export_name
+
+logger = logging.getLogger()
+
+CLOUDWATCH_NAMESPACE = 'GlueCM'
+
+# Largest page get_job_runs allows
+JOB_RUNS_PAGE_SIZE = 200
+
+# Job run states that can still change
+IN_FLIGHT_STATES = {'STARTING', 'RUNNING', 'STOPPING', 'WAITING'}
+
+
+class JobRun(NamedTuple):
+    # One Glue job run, as returned by get_job_runs
+    job_name: str
+    run_id: str
+    state: str
+    started_on: object
+    completed_on: Optional[object]
+    execution_time: int
+    dpu_seconds: Optional[float]
+    worker_type: str
+    allocated_capacity: float
+    glue_version: Optional[str]
+
+
+def round_to_nearest_half_hour(dt):
+    # Round to the nearest half-hour (00 or 30)
+    minute = dt.minute
+    if minute < 15:
+        dt = dt.replace(minute=0, second=0, microsecond=0)
+    elif minute < 45:
+        dt = dt.replace(minute=30, second=0, microsecond=0)
+    else:
+        dt = dt.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return dt
+
+
+def status_count_window(current_time):
+    # The rounded hour used for JobStatusCount
+    end_time = round_to_nearest_half_hour(current_time)
+    start_time = end_time - timedelta(minutes=60)  # One hour before the rounded time
+    return start_time, end_time
+
+
+def to_utc(dt):
+    # boto3 returns aware datetimes, but be safe with naive ones
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def job_run_from_api(job_name, run):
+    return JobRun(
+        job_name=job_name,
+        run_id=run['Id'],
+        state=run.get('JobRunState'),
+        started_on=to_utc(run['StartedOn']),
+        completed_on=to_utc(run.get('CompletedOn')),
+        execution_time=run.get('ExecutionTime', 0),
+        dpu_seconds=run.get('DPUSeconds'),
+        worker_type=run.get('WorkerType', 'Standard'),
+        allocated_capacity=run.get('AllocatedCapacity', 0),
+        glue_version=run.get('GlueVersion'),
+    )
+
+
+def list_job_names(glue_client):
+    # List all Glue jobs with pagination
+    job_names = []
+    next_token = None
+
+    while True:
+        if next_token:
+            response = glue_client.get_jobs(NextToken=next_token)
+        else:
+            response = glue_client.get_jobs()
+
+        job_names.extend(job['Name'] for job in response['Jobs'])
+        next_token = response.get('NextToken')
+
+        if not next_token:
+            break
+
+    return job_names
+
+
+def list_job_names_only(glue_client):
+    # ListJobs returns only names, up to 1000 a page, so it is much cheaper
+    # than get_jobs when all that's needed is the job list
+    job_names = []
+    next_token = None
+
+    while True:
+        if next_token:
+            response = glue_client.list_jobs(MaxResults=1000, NextToken=next_token)
+        else:
+            response = glue_client.list_jobs(MaxResults=1000)
+
+        job_names.extend(response['JobNames'])
+        next_token = response.get('NextToken')
+
+        if not next_token:
+            break
+
+    return job_names
+
+
+def iter_job_runs(glue_client, job_name, start_time, end_time, page_size=JOB_RUNS_PAGE_SIZE):
+    # Yield the runs of one job started within [start_time, end_time].
+    # get_job_runs returns runs newest first, so paging stops at the first
+    # page that reaches back past start_time. If a run is ever newer than
+    # one already seen the ordering can't be trusted and the job is paged
+    # to the end instead.
+    next_token = None
+    oldest_started_on = None
+    ordered = True
+
+    while True:
+        if next_token:
+            response = glue_client.get_job_runs(JobName=job_name, MaxResults=page_size, NextToken=next_token)
+        else:
+            response = glue_client.get_job_runs(JobName=job_name, MaxResults=page_size)
+
+        reached_start = False
+        for run in response.get('JobRuns', []):
+            if 'StartedOn' not in run:
+                continue
+            job_run = job_run_from_api(job_name, run)
+
+            if oldest_started_on is not None and job_run.started_on > oldest_started_on:
+                if ordered:
+                    logger.warning(f"Job runs for {job_name} are not newest first, reading all pages.")
+                    ordered = False
+            else:
+                oldest_started_on = job_run.started_on
+
+            if job_run.started_on < start_time:
+                reached_start = True
+            elif job_run.started_on <= end_time:
+                yield job_run
+
+        next_token = response.get('NextToken')
+        if not next_token or (ordered and reached_start):
+            break
+
+
+class Aggregator:
+    # Base class for the metric families computed over one scan.
+    # Each aggregator only counts runs that fall in its own window.
+    # per_job families can be published job by job; the others only once
+    # every job has been scanned.
+    per_job = True
+
+    def __init__(self, start_time, end_time):
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def add_job(self, job_name):
+        pass
+
+    def add(self, run):
+        if self.start_time <= run.started_on <= self.end_time:
+            self.add_run(run)
+
+    def add_run(self, run):
+        raise NotImplementedError
+
+    def metric_data(self):
+        raise NotImplementedError
+
+    def close(self):
+        # Called once the scan feeding this aggregator is done
+        pass
+
+    def spec(self):
+        # What a shard worker needs to build the same aggregator
+        return {'type': type(self).__name__, 'start_time': self.start_time.isoformat(),
+                'end_time': self.end_time.isoformat()}
+
+    def partial(self):
+        # JSON serialisable state, to be merged into another aggregator
+        raise NotImplementedError
+
+    def merge(self, partial):
+        raise NotImplementedError
+
+
+class JobStatusCounts(Aggregator):
+    # Per-job JobStatusCount metrics (Running/Succeeded/Failed)
+    STATUSES = {'RUNNING': 'Running', 'SUCCEEDED': 'Succeeded', 'FAILED': 'Failed'}
+
+    def __init__(self, start_time, end_time):
+        super().__init__(start_time, end_time)
+        self.job_counts = {}
+
+    def add_job(self, job_name):
+        self.job_counts.setdefault(job_name, {status: 0 for status in self.STATUSES.values()})
+
+    def add_run(self, run):
+        status = self.STATUSES.get(run.state)
+        if status:
+            self.add_job(run.job_name)
+            self.job_counts[run.job_name][status] += 1
+
+    def partial(self):
+        return {'job_counts': self.job_counts}
+
+    def merge(self, partial):
+        for job_name, counts in partial['job_counts'].items():
+            self.add_job(job_name)
+            for status, count in counts.items():
+                self.job_counts[job_name][status] += count
+
+    def metric_data(self):
+        metric_data = []
+        for job_name, counts in self.job_counts.items():
+            for status, count in counts.items():
+                metric_data.append({
+                    'MetricName': 'JobStatusCount',
+                    'Value': count,
+                    'Unit': 'Count',
+                    'Dimensions': [
+                        {'Name': 'JobName', 'Value': job_name},
+                        {'Name': 'Status', 'Value': status}
+                    ]
+                })
+        return metric_data
+
+
+class FleetTotals(Aggregator):
+    # Fleet wide Glue.* totals and success rate
+    per_job = False
+
+    def __init__(self, start_time, end_time):
+        super().__init__(start_time, end_time)
+        self.total_runs = 0
+        self.running = 0
+        self.canceled = 0
+        self.successful_runs = 0
+        self.failed_runs = 0
+
+    def add_run(self, run):
+        self.total_runs += 1
+        if run.state == 'SUCCEEDED':
+            self.successful_runs += 1
+        elif run.state == 'FAILED':
+            self.failed_runs += 1
+        elif run.state == 'RUNNING':
+            self.running += 1
+        elif run.state == 'CANCELED':
+            self.canceled += 1
+
+    COUNTERS = ('total_runs', 'running', 'canceled', 'successful_runs', 'failed_runs')
+
+    def partial(self):
+        return {counter: getattr(self, counter) for counter in self.COUNTERS}
+
+    def merge(self, partial):
+        for counter in self.COUNTERS:
+            setattr(self, counter, getattr(self, counter) + partial[counter])
+
+    @property
+    def run_success_rate(self):
+        return (self.successful_runs / self.total_runs) * 100 if self.total_runs > 0 else 0
+
+    def metric_data(self, timestamp=None):
+        values = [
+            ('Glue.TotalRuns', self.total_runs, 'Count'),
+            ('Glue.RunningJobs', self.running, 'Count'),
+            ('Glue.CanceledJobs', self.canceled, 'Count'),
+            ('Glue.SuccessfulRuns', self.successful_runs, 'Count'),
+            ('Glue.FailedRuns', self.failed_runs, 'Count'),
+            ('Glue.RunSuccessRate', self.run_success_rate, 'Percent'),
+        ]
+        metric_data = []
+        for metric_name, value, unit in values:
+            datum = {'MetricName': metric_name, 'Value': value, 'Unit': unit}
+            if timestamp is not None:
+                datum['Timestamp'] = timestamp
+            metric_data.append(datum)
+        return metric_data
+
+
+def cached_run_cost(run, cache):
+    # (dpu_seconds, cost) of a run. Finished runs can't change, so their
+    # cost is computed once and cached.
+    if run.state in IN_FLIGHT_STATES:
+        return run_cost(run)
+    cached = cache.get(run.run_id)
+    if cached is None:
+        cached = run_cost(run)
+        cache.put(run.run_id, cached)
+    return cached
+
+
+class DpuCost(Aggregator):
+    # Per-job DPU_Seconds and DPU_Cost
+
+    def __init__(self, start_time, end_time, cache=finished_run_costs):
+        super().__init__(start_time, end_time)
+        self.cache = cache
+        self.job_metrics = {}
+
+    def add_run(self, run):
+        dpu_seconds, job_cost = cached_run_cost(run, self.cache)
+
+        # Aggregate metrics for the job
+        if run.job_name not in self.job_metrics:
+            self.job_metrics[run.job_name] = {'DPUSeconds': 0, 'Cost': 0}
+
+        self.job_metrics[run.job_name]['DPUSeconds'] += dpu_seconds
+        self.job_metrics[run.job_name]['Cost'] += round(job_cost, 2)
+
+    def partial(self):
+        return {'job_metrics': self.job_metrics}
+
+    def merge(self, partial):
+        for job_name, metrics in partial['job_metrics'].items():
+            totals = self.job_metrics.setdefault(job_name, {'DPUSeconds': 0, 'Cost': 0})
+            totals['DPUSeconds'] += metrics['DPUSeconds']
+            totals['Cost'] += metrics['Cost']
+
+    def job_metric_data(self, job_name):
+        metrics = self.job_metrics[job_name]
+        dimensions = [{'Name': 'JobName', 'Value': job_name}]
+        return [
+            {
+                'MetricName': 'DPU_Seconds',
+                'Dimensions': dimensions,
+                'Value': metrics['DPUSeconds'],
+                'Unit': 'Seconds'
+            },
+            {
+                'MetricName': 'DPU_Cost',
+                'Dimensions': dimensions,
+                'Value': metrics['Cost'],
+                'Unit': 'None'  # Cost doesn't have a specific unit
+            }
+        ]
+
+    def metric_data(self):
+        metric_data = []
+        for job_name in self.job_metrics:
+            metric_data.extend(self.job_metric_data(job_name))
+        return metric_data
+
+
+class RunDistribution(Aggregator):
+    # Per-job distribution of ExecutionTime and DPU-seconds over finished
+    # runs: a StatisticValues set plus p50/p95/p99 series. Runs are kept in a
+    # columnar buffer so millions of them stay cheap to hold and sort.
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, start_time, end_time):
+        super().__init__(start_time, end_time)
+        self.columns = RunColumns()
+
+    def add_run(self, run):
+        dpu_seconds = run.dpu_seconds if run.dpu_seconds is not None else run_cost(run)[0]
+        self.columns.append(run.job_name, run.state, run.started_on.timestamp(), run.execution_time or 0, dpu_seconds)
+
+    def partial(self):
+        return {'columns': self.columns.to_dict()}
+
+    def merge(self, partial):
+        self.columns.extend(partial['columns'])
+
+    def metric_data(self):
+        metric_data = []
+        for metric_name, values in [('JobRunExecutionTime', self.columns.execution_time),
+                                    ('JobRunDPUSeconds', self.columns.dpu_seconds)]:
+            stats = grouped_stats(self.columns, values, self.QUANTILES, exclude_states=IN_FLIGHT_STATES)
+            for job_index, (count, total, minimum, maximum, percentiles) in stats.items():
+                dimensions = [{'Name': 'JobName', 'Value': self.columns.job_names[job_index]}]
+                metric_data.append({
+                    'MetricName': metric_name,
+                    'Dimensions': dimensions,
+                    'StatisticValues': {'SampleCount': count, 'Sum': total, 'Minimum': minimum, 'Maximum': maximum},
+                    'Unit': 'Seconds'
+                })
+                for quantile, value in zip(self.QUANTILES, percentiles):
+                    metric_data.append({
+                        'MetricName': f"{metric_name}.p{int(quantile * 100)}",
+                        'Dimensions': dimensions,
+                        'Value': value,
+                        'Unit': 'Seconds'
+                    })
+        return metric_data
+
+
+class RunExport(Aggregator):
+    # Streams one record per run in the window to RUN_EXPORT_URI as the scan
+    # goes, so the export needs no scan of its own. Every scan writing to one
+    # (a shard, a continuation part) gets its own file; partial() lists them.
+    # Publishes no metrics.
+    FIELDS = [
+        ('job_name', 'string'),
+        ('run_id', 'string'),
+        ('state', 'string'),
+        ('started_on', 'timestamp'),
+        ('execution_time', 'int'),
+        ('dpu_seconds', 'float'),
+        ('cost', 'float'),
+    ]
+
+    def __init__(self, start_time, end_time, uri=None, cache=finished_run_costs):
+        super().__init__(start_time, end_time)
+        self.cache = cache
+        self.writer = RecordWriter(uri or EXPORT_URI, export_name('glue-runs', end_time), self.FIELDS)
+        self.files = []
+
+    def add_run(self, run):
+        dpu_seconds, cost = cached_run_cost(run, self.cache)
+        self.writer.write({
+            'job_name': run.job_name,
+            'run_id': run.run_id,
+            'state': run.state,
+            'started_on': run.started_on,
+            'execution_time': run.execution_time,
+            'dpu_seconds': dpu_seconds,
+            'cost': cost,
+        })
+
+    def close(self):
+        location = self.writer.close()
+        if location is not None:
+            self.files.append(location)
+
+    def partial(self):
+        return {'files': self.files}
+
+    def merge(self, partial):
+        self.files.extend(partial['files'])
+
+    def metric_data(self):
+        return []
+
+
+AGGREGATORS = {aggregator.__name__: aggregator
+               for aggregator in (JobStatusCounts, FleetTotals, DpuCost, RunDistribution, RunExport)}
+
+
+def aggregator_from_spec(spec):
+    return AGGREGATORS[spec['type']](datetime.fromisoformat(spec['start_time']),
+                                     datetime.fromisoformat(spec['end_time']))
+
+
+def scan(glue_client, aggregators, state_store=None, fetcher=None, job_names=None, deadline=None, unscanned=None):
+    # Walk every job and its runs once, feeding each run to all aggregators.
+    # The scan window is the union of the aggregator windows. With a state
+    # store only new and unfinished runs are fetched from Glue. Jobs are
+    # fetched concurrently, aggregators are only touched from this thread.
+    # job_names limits the scan to those jobs, e.g. one shard of the fleet.
+    # Once the deadline expires no more jobs are started; their names are
+    # added to unscanned.
+    from glue_fetcher import GlueFetcher
+    from glue_state import iter_job_runs_incremental
+
+    start_time = min(aggregator.start_time for aggregator in aggregators)
+    end_time = max(aggregator.end_time for aggregator in aggregators)
+    fetcher = fetcher or GlueFetcher(glue_client)
+
+    def fetch_job_runs(client, job_name):
+        if deadline is not None and deadline.expired():
+            return None
+        if state_store is not None:
+            return list(iter_job_runs_incremental(client, state_store, job_name, start_time, end_time))
+        return list(iter_job_runs(client, job_name, start_time, end_time))
+
+    if job_names is None:
+        job_names = list_job_names(fetcher.client)
+    run_count = 0
+
+    skipped = 0
+
+    try:
+        for job_name, runs in fetcher.map(fetch_job_runs, job_names):
+            if runs is None:
+                skipped += 1
+                if unscanned is not None:
+                    unscanned.append(job_name)
+                continue
+
+            for aggregator in aggregators:
+                aggregator.add_job(job_name)
+
+            for run in runs:
+                run_count += 1
+                for aggregator in aggregators:
+                    aggregator.add(run)
+    finally:
+        for aggregator in aggregators:
+            aggregator.close()
+
+    logger.info(f"Scanned {len(job_names) - skipped} jobs, {run_count} runs between {start_time} and {end_time}.")
+    if skipped:
+        logger.warning(f"Deadline reached, {skipped} jobs were not scanned.")
+    return run_count
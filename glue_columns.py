@@ -0,0 +1,116 @@
+import math
+from array import array
+
+# Job run states as small integer codes for the state column
+STATES = ['STARTING', 'RUNNING', 'STOPPING', 'STOPPED', 'SUCCEEDED', 'FAILED', 'TIMEOUT', 'ERROR', 'WAITING',
+          'EXPIRED', None]
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+
+def _numpy():
+    # NumPy is optional and only imported when stats are computed
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class RunColumns:
+    # Job runs as parallel typed arrays instead of a list of dicts or
+    # tuples, about 29 bytes per run. Job names are stored once and
+    # referenced by index.
+
+    def __init__(self):
+        self.job_names = []
+        self.job_indexes = {}
+        self.job_index = array('I')
+        self.state = array('b')
+        self.started_on = array('d')  # epoch seconds
+        self.execution_time = array('d')
+        self.dpu_seconds = array('d')
+
+    def __len__(self):
+        return len(self.job_index)
+
+    def job(self, job_name):
+        index = self.job_indexes.get(job_name)
+        if index is None:
+            index = self.job_indexes[job_name] = len(self.job_names)
+            self.job_names.append(job_name)
+        return index
+
+    def append(self, job_name, state, started_on, execution_time, dpu_seconds):
+        self.job_index.append(self.job(job_name))
+        self.state.append(STATE_CODES.get(state, STATE_CODES[None]))
+        self.started_on.append(started_on)
+        self.execution_time.append(execution_time)
+        self.dpu_seconds.append(dpu_seconds)
+
+    COLUMNS = ('job_index', 'state', 'started_on', 'execution_time', 'dpu_seconds')
+
+    def to_dict(self):
+        return dict({column: getattr(self, column).tolist() for column in self.COLUMNS}, job_names=self.job_names)
+
+    def extend(self, columns):
+        # Append the rows of another buffer's to_dict(), re-indexing its jobs
+        mapping = [self.job(job_name) for job_name in columns['job_names']]
+        self.job_index.extend(mapping[index] for index in columns['job_index'])
+        for column in self.COLUMNS[1:]:
+            getattr(self, column).extend(columns[column])
+
+
+def _percentile(sorted_values, q):
+    # Linear interpolation between closest ranks, as numpy.percentile does
+    position = (len(sorted_values) - 1) * q
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def grouped_stats(columns, values, quantiles, exclude_states=()):
+    # {job index: (count, sum, min, max, [quantile values])} of one value
+    # column, skipping runs in exclude_states. Vectorised with NumPy when it
+    # is installed.
+    excluded = {STATE_CODES[state] for state in exclude_states}
+    np = _numpy()
+    if np is None:
+        groups = {}
+        for index, state, value in zip(columns.job_index, columns.state, values):
+            if state not in excluded:
+                groups.setdefault(index, []).append(value)
+        stats = {}
+        for index, group in groups.items():
+            group.sort()
+            stats[index] = (len(group), sum(group), group[0], group[-1], [_percentile(group, q) for q in quantiles])
+        return stats
+
+    if not len(columns):
+        return {}
+    mask = ~np.isin(np.frombuffer(columns.state, dtype=np.int8), list(excluded))
+    jobs = np.frombuffer(columns.job_index, dtype=np.uint32)[mask]
+    data = np.frombuffer(values, dtype=np.float64)[mask]
+    if not len(data):
+        return {}
+
+    # By value, then a stable (radix) sort by job index keeps each job's
+    # values in order; quicker than lexsort on both keys
+    order = np.argsort(data)
+    order = order[np.argsort(jobs[order], kind='stable')]
+    jobs, data = jobs[order], data[order]
+    unique, starts, counts = np.unique(jobs, return_index=True, return_counts=True)
+    sums = np.add.reduceat(data, starts)
+    mins = data[starts]
+    maxes = data[starts + counts - 1]
+
+    percentiles = []
+    for q in quantiles:
+        position = (counts - 1) * q
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        low, high = data[starts + lower], data[starts + upper]
+        percentiles.append(low + (high - low) * (position - lower))
+
+    return {int(index): (int(counts[i]), float(sums[i]), float(mins[i]), float(maxes[i]),
+                         [float(p[i]) for p in percentiles])
+            for i, index in enumerate(unique)}
@@ -0,0 +1,70 @@
+import os
+import time
+from collections import OrderedDict
+
+# USD per hour for one unit of capacity, keyed by (WorkerType, GlueVersion).
+# A version of None matches any Glue version; add a (worker_type, '4.0')
+# entry to price one version differently.
+RATE_TABLE = {
+    ('Standard', None): 0.44,  # USD for Glue 1.0
+    ('G.025X', None): 0.11,
+    ('G.1X', None): 0.44,  # USD for G.1X worker type
+    ('G.2X', None): 0.88,  # USD for G.2X worker type
+    ('G.4X', None): 1.76,
+    ('G.8X', None): 3.52,
+    ('Z.2X', None): 0.88,
+}
+DEFAULT_RATE = RATE_TABLE[('Standard', None)]
+
+# Same table per DPU second, so a run costs one multiply
+RATE_PER_SECOND = {key: rate / 3600 for key, rate in RATE_TABLE.items()}
+
+CACHE_SIZE = int(os.getenv('GLUE_COST_CACHE_SIZE', '50000'))  # Finished runs remembered
+CACHE_TTL = int(os.getenv('GLUE_COST_CACHE_TTL', '7200'))  # Seconds
+
+
+def rate_per_second(worker_type, glue_version):
+    rate = RATE_PER_SECOND.get((worker_type, glue_version))
+    if rate is None:
+        rate = RATE_PER_SECOND.get((worker_type, None), DEFAULT_RATE / 3600)
+    return rate
+
+
+def run_cost(run):
+    # Returns (dpu_seconds, cost) for a job run from its get_job_runs fields.
+    # Runs without DPUSeconds are billed on ExecutionTime x AllocatedCapacity.
+    dpu_seconds = run.dpu_seconds
+    if dpu_seconds is None:
+        dpu_seconds = run.execution_time * run.allocated_capacity
+    return dpu_seconds, rate_per_second(run.worker_type, run.glue_version) * dpu_seconds
+
+
+class RunCostCache:
+    # Bounded LRU of finished run costs with a TTL, kept across warm invocations
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, run_id):
+        entry = self.entries.get(run_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[run_id]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(run_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, run_id, value):
+        self.entries[run_id] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(run_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+finished_run_costs = RunCostCache()
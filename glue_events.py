@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from glue_collector import IN_FLIGHT_STATES, job_run_from_api, list_job_names_only
+from glue_state import job_run_from_item, job_run_to_item
+
+logger = logging.getLogger()
+
+# EventBridge "Glue Job State Change" events, delivered directly or as SQS
+# messages, are recorded per run in the state store, one item per run grouped
+# by the hour it started. The scheduled tick then builds the usual metric
+# families from the recorded runs instead of scanning every job.
+DETAIL_TYPE = 'Glue Job State Change'
+COLLECT_MODE = os.getenv('GLUE_COLLECT_MODE', 'poll')  # 'poll' scans Glue, 'events' replays recorded runs
+JOB_LIST_TTL = int(os.getenv('GLUE_JOB_LIST_TTL', '3600'))  # Seconds the job list is reused for zero counts
+
+RUN_BUCKET_FORMAT = '%Y-%m-%dT%H'  # Recorded runs are grouped by the hour they started
+PRUNED_KEY = 'events/pruned_through'  # Newest hour whose recorded runs have been deleted
+FIRST_PRUNE_HOURS = 24  # Hours before the window cleared on the first prune
+
+job_list = {'names': None, 'fetched_at': 0}
+
+
+def is_state_change_batch(event):
+    if event.get('detail-type') == DETAIL_TYPE:
+        return True
+    records = event.get('Records')
+    return bool(records) and records[0].get('eventSource') == 'aws:sqs'
+
+
+def iter_state_changes(event):
+    # (item id, event detail) for every Glue Job State Change in the batch.
+    # Messages that can't be parsed come back with detail None.
+    if event.get('detail-type') == DETAIL_TYPE:
+        yield event.get('id'), event['detail']
+        return
+
+    for record in event.get('Records', []):
+        try:
+            body = json.loads(record['body'])
+        except (KeyError, ValueError):
+            logger.error(f"Unreadable SQS message {record.get('messageId')}")
+            yield record.get('messageId'), None
+            continue
+        if body.get('detail-type') == DETAIL_TYPE:
+            yield record['messageId'], body['detail']
+
+
+def supersedes(new_state, old_state):
+    # A finished state is never replaced by a late in-flight one
+    return old_state is None or old_state in IN_FLIGHT_STATES or new_state not in IN_FLIGHT_STATES
+
+
+def bucket_key(started_on):
+    return f"events/runs/{started_on.astimezone(timezone.utc).strftime(RUN_BUCKET_FORMAT)}"
+
+
+def run_key(run_id):
+    return f"events/run/{run_id}"
+
+
+def record_state_changes(glue_client, store, event):
+    # Record the runs named in a batch of state change events. Each run is
+    # fetched once per new state (events carry no timings or DPU figures) and
+    # stored as its own item, so concurrent batches never overwrite each
+    # other; repeated or out of order events are skipped using the stored
+    # state. Runs that started in an hour already pruned can't be replayed
+    # any more and are dropped. Returns the ids of the items that failed,
+    # for SQS partial batch retry.
+    changes = {}  # run_id -> (item ids, detail)
+    failed = []
+    for item_id, detail in iter_state_changes(event):
+        if not detail or 'jobRunId' not in detail or 'jobName' not in detail:
+            failed.append(item_id)
+            continue
+        item_ids, current = changes.get(detail['jobRunId'], ([], None))
+        item_ids.append(item_id)
+        if current is None or supersedes(detail.get('state'), current.get('state')):
+            current = detail
+        changes[detail['jobRunId']] = (item_ids, current)
+
+    from glue_fetcher import throttled_client
+
+    glue_client = throttled_client(glue_client)
+    pruned = store.get(PRUNED_KEY)
+    recorded = 0
+    skipped = 0
+    for run_id, (item_ids, detail) in changes.items():
+        try:
+            seen = store.get(run_key(run_id))
+            if seen and (seen['state'] == detail.get('state') or not supersedes(detail.get('state'), seen['state'])):
+                skipped += 1
+                continue
+
+            response = glue_client.get_job_run(JobName=detail['jobName'], RunId=run_id)
+            run = job_run_from_api(detail['jobName'], response['JobRun'])
+            group = bucket_key(run.started_on)
+            if pruned and group <= pruned['bucket']:
+                skipped += 1
+                continue
+            store.put_in_group(group, run_key(run_id), job_run_to_item(run))
+            recorded += 1
+        except Exception as e:
+            logger.error(f"Failed to record job run {run_id} of {detail.get('jobName')}: {str(e)}")
+            failed.extend(item_ids)
+
+    logger.info(f"Recorded {recorded} job runs from state change events, "
+                f"skipped {skipped} duplicates or expired runs, {len(failed)} items failed.")
+    return failed
+
+
+def prune_recorded_runs(store, start_time):
+    # Delete the hours of recorded runs that end before start_time, the start
+    # of the widest window; no later tick replays them
+    last_hour = start_time.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    pruned = store.get(PRUNED_KEY)
+    if pruned is not None:
+        hour = datetime.strptime(pruned['bucket'][len('events/runs/'):], RUN_BUCKET_FORMAT).replace(
+            tzinfo=timezone.utc) + timedelta(hours=1)
+    else:
+        hour = last_hour - timedelta(hours=FIRST_PRUNE_HOURS)
+
+    hours = 0
+    while hour <= last_hour:
+        store.delete_group(bucket_key(hour))
+        hour += timedelta(hours=1)
+        hours += 1
+    if hours:
+        store.put(PRUNED_KEY, {'bucket': bucket_key(last_hour)})
+        logger.info(f"Pruned recorded runs of {hours} hours up to {bucket_key(last_hour)}.")
+
+
+def known_job_names(glue_client):
+    # Job list for zero counts, refreshed every JOB_LIST_TTL seconds
+    if job_list['names'] is None or time.time() - job_list['fetched_at'] > JOB_LIST_TTL:
+        from glue_fetcher import throttled_client
+        job_list['names'] = list_job_names_only(throttled_client(glue_client))
+        job_list['fetched_at'] = time.time()
+    return job_list['names']
+
+
+def replay_recorded_runs(glue_client, store, aggregators):
+    # Feed the recorded runs overlapping the aggregator windows to the
+    # aggregators, as scan() would. Returns the run count.
+    start_time = min(aggregator.start_time for aggregator in aggregators)
+    end_time = max(aggregator.end_time for aggregator in aggregators)
+
+    for job_name in known_job_names(glue_client):
+        for aggregator in aggregators:
+            aggregator.add_job(job_name)
+
+    run_count = 0
+    hour = start_time.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    while hour <= end_time:
+        for item in store.get_group(bucket_key(hour)).values():
+            run = job_run_from_item(item)
+            if start_time <= run.started_on <= end_time:
+                run_count += 1
+                for aggregator in aggregators:
+                    aggregator.add(run)
+        hour += timedelta(hours=1)
+
+    for aggregator in aggregators:
+        aggregator.close()
+
+    prune_recorded_runs(store, start_time)
+
+    logger.info(f"Replayed {run_count} recorded runs between {start_time} and {end_time}.")
+    return run_count
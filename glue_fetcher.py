@@ -0,0 +1,200 @@
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import BotoCoreError, ClientError, ConnectionError, HTTPClientError
+
+logger = logging.getLogger()
+
+# Error codes Glue uses when we call it too fast
+THROTTLE_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'Throttling', 'RequestLimitExceeded'}
+
+MAX_WORKERS = int(os.getenv('GLUE_MAX_WORKERS', '16'))  # Upper bound on concurrent Glue calls
+REQUESTS_PER_SECOND = float(os.getenv('GLUE_REQUESTS_PER_SECOND', '20'))  # Client side rate limit
+RETRY_BUDGET = int(os.getenv('GLUE_RETRY_BUDGET', '5'))  # Retries allowed per call; the Glue client itself makes none
+
+BACKOFF_BASE = 0.2  # Seconds
+BACKOFF_MAX = 5.0  # Seconds
+
+
+def is_throttle(error):
+    code = (getattr(error, 'response', None) or {}).get('Error', {}).get('Code')
+    return code in THROTTLE_ERROR_CODES
+
+
+def is_transient(error):
+    # Server errors and dropped or timed out connections, which the SDK
+    # would retry for other services
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    return (getattr(error, 'response', None) or {}).get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+
+class TokenBucket:
+    # Allows `rate` calls per second with bursts of up to `burst` calls
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    # Concurrency limit that grows by one after a full window of successful
+    # calls and halves on every throttle (AIMD).
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.in_use = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_use >= self.limit:
+                self.condition.wait()
+            self.in_use += 1
+
+    def release(self):
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            limit = max(self.minimum, self.limit // 2)
+            if limit != self.limit:
+                logger.info(f"Glue throttled, concurrency {self.limit} -> {limit}")
+            self.limit = limit
+            self.successes = 0
+
+
+class ThrottledClient:
+    # Wraps a boto3 client so every call goes through the token bucket and
+    # the adaptive limit, retrying throttles and transient errors within the
+    # retry budget. Only throttles lower the limit.
+
+    def __init__(self, client, bucket, limit, retry_budget):
+        self.client = client
+        self.bucket = bucket
+        self.limit = limit
+        self.retry_budget = retry_budget
+        self.throttles = 0
+
+    @property
+    def exceptions(self):
+        return self.client.exceptions
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                self.bucket.acquire()
+                self.limit.acquire()
+                try:
+                    result = method(*args, **kwargs)
+                except Exception as e:
+                    if not (is_throttle(e) or is_transient(e)) or attempt >= self.retry_budget:
+                        raise
+                    if is_throttle(e):
+                        self.throttles += 1
+                        self.limit.on_throttle()
+                else:
+                    self.limit.on_success()
+                    return result
+                finally:
+                    self.limit.release()
+
+                attempt += 1
+                time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+        return call
+
+
+class GlueFetcher:
+    # Bounded thread pool for per-job Glue calls
+
+    def __init__(self, glue_client, max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND,
+                 retry_budget=RETRY_BUDGET):
+        self.max_workers = max_workers
+        self.limit = AdaptiveLimit(max_workers)
+        self.client = ThrottledClient(glue_client, TokenBucket(requests_per_second), self.limit, retry_budget)
+
+    def map(self, fn, items):
+        # Yields (item, fn(client, item)) as each call finishes. At most
+        # twice max_workers calls are queued ahead of the consumer, and items
+        # are started in order. An item whose call fails with anything but
+        # an exhausted throttle retry budget, e.g. a job deleted since it was
+        # listed or a connection that kept failing, is logged and left out.
+        items = iter(items)
+        if self.max_workers <= 1:
+            for item in items:
+                try:
+                    result = fn(self.client, item)
+                except (BotoCoreError, ClientError) as e:
+                    self._skip(item, e)
+                    continue
+                yield item, result
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(fn, self.client, item): item
+                       for item in itertools.islice(items, self.max_workers * 2)}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = futures.pop(future)
+                    for next_item in itertools.islice(items, 1):
+                        futures[executor.submit(fn, self.client, next_item)] = next_item
+                    try:
+                        result = future.result()
+                    except (BotoCoreError, ClientError) as e:
+                        self._skip(item, e)
+                        continue
+                    yield item, result
+
+        if self.client.throttles:
+            logger.info(f"Glue throttled {self.client.throttles} calls, final concurrency {self.limit.limit}.")
+
+    def _skip(self, item, error):
+        if is_throttle(error):
+            raise error
+        logger.error(f"Glue call for {item} failed, skipping it: {str(error)}")
+
+
+def throttled_client(glue_client):
+    # glue_client behind the same rate limit and retries, for Glue calls made
+    # outside GlueFetcher.map
+    return GlueFetcher(glue_client).client
@@ -0,0 +1,137 @@
+import logging
+import os
+from typing import NamedTuple
+
+from deadline import MAX_CONTINUATIONS, Deadline, hand_off
+from glue_collector import aggregator_from_spec, list_job_names, scan
+
+logger = logging.getLogger()
+
+CONTINUATION_EVENT_KEY = 'glue_continuation'
+# Windows that may wait behind an unfinished collection; older ones are dropped
+MAX_QUEUED_WINDOWS = int(os.getenv('MAX_QUEUED_WINDOWS', '3'))
+
+
+class Collection(NamedTuple):
+    # What one invocation of collect() did
+    aggregators: list
+    run_count: int
+    finished: bool
+    published: object  # whatever publish() returned
+
+
+def continuation_key(collector):
+    return f"continuation/{collector}"
+
+
+def take_saved_continuation(state_store, collector):
+    # A continuation left by an earlier tick that couldn't re-invoke itself
+    if state_store is None:
+        return None
+    continuation = state_store.get(continuation_key(collector))
+    if continuation is not None:
+        state_store.delete(continuation_key(collector))
+    return continuation
+
+
+def collect(collector, glue_client, aggregators, publish, context=None, state_store=None, continuation=None):
+    # scan() that stops before the Lambda deadline. aggregators are a new
+    # window to collect, continuation the rest of an earlier one. A
+    # scheduled tick (no continuation) first finishes any continuation an
+    # earlier tick saved, with its own window queued behind it. Jobs are
+    # scanned in name order; whatever is done by then is published with
+    # publish(aggregators, finished), and the rest is handed to another
+    # invocation with a cursor: the aggregator windows, which jobs are left,
+    # the partial state of the aggregators that are only published at
+    # the end and the windows queued behind it.
+    deadline = Deadline(context)
+    queued = []
+    if continuation is None:
+        continuation = take_saved_continuation(state_store, collector)
+        if continuation is not None:
+            logger.info(f"Finishing a saved {collector} collection before this tick's window.")
+            queued = [[aggregator.spec() for aggregator in aggregators]]
+    if continuation is not None:
+        queued = continuation.get('queued', []) + queued
+    if len(queued) > MAX_QUEUED_WINDOWS:
+        logger.error(f"{len(queued)} {collector} windows waiting, dropping the oldest "
+                     f"{len(queued) - MAX_QUEUED_WINDOWS}.")
+        queued = queued[-MAX_QUEUED_WINDOWS:]
+
+    while True:
+        collection, cursor = collect_part(collector, glue_client, aggregators, publish, deadline, state_store,
+                                          continuation)
+        if cursor is not None or not queued:
+            break
+        aggregators = [aggregator_from_spec(spec) for spec in queued.pop(0)]
+        continuation = None
+        if deadline.expired():
+            # Not started: hand it on as a cursor with nothing done yet
+            cursor = new_cursor(collector, aggregators, None, [], 0)
+            break
+
+    if cursor is not None:
+        cursor['queued'] = queued
+        save = None
+        if state_store is not None:
+            def save(payload):
+                state_store.put(continuation_key(collector), payload[CONTINUATION_EVENT_KEY])
+        hand_off(context, {CONTINUATION_EVENT_KEY: cursor}, save=save)
+
+    return collection
+
+
+def new_cursor(collector, aggregators, next_job, done_after, part):
+    # The jobs left are those from next_job on (all of them when None) that
+    # aren't in done_after. Jobs are started in name order, so done_after
+    # only holds the few that were already running when the deadline came,
+    # and the cursor stays small however many jobs are left.
+    return {
+        'collector': collector,
+        'aggregators': [aggregator.spec() for aggregator in aggregators],
+        'carry': [None if aggregator.per_job else aggregator.partial() for aggregator in aggregators],
+        'next_job': next_job,
+        'done_after': done_after,
+        'part': part,
+    }
+
+
+def collect_part(collector, glue_client, aggregators, publish, deadline, state_store=None, continuation=None):
+    # One invocation's part of one window. Returns the Collection and the
+    # cursor to hand on, or None when the window is finished.
+    from glue_fetcher import GlueFetcher
+
+    fetcher = GlueFetcher(glue_client)
+    job_names = sorted(list_job_names(fetcher.client))
+    part = 1
+    done_earlier = []
+    if continuation is not None:
+        aggregators = [aggregator_from_spec(spec) for spec in continuation['aggregators']]
+        for aggregator, partial in zip(aggregators, continuation['carry']):
+            if partial is not None:
+                aggregator.merge(partial)
+        part = continuation['part'] + 1
+        if continuation['next_job'] is not None:
+            done_earlier = continuation['done_after']
+            skip = set(done_earlier)
+            job_names = [name for name in job_names if name >= continuation['next_job'] and name not in skip]
+            logger.info(f"Continuing {collector} collection, part {part}, from job {continuation['next_job']}.")
+
+    unscanned = []
+    run_count = scan(glue_client, aggregators, state_store=state_store, fetcher=fetcher, job_names=job_names,
+                     deadline=deadline, unscanned=unscanned)
+
+    finished = not unscanned
+    if not finished and part >= MAX_CONTINUATIONS:
+        logger.error(f"{collector} collection still unfinished after {part} invocations, "
+                     f"publishing without {len(unscanned)} jobs.")
+        finished = True
+
+    published = publish(aggregators, finished)
+    cursor = None
+    if not finished:
+        next_job = min(unscanned)
+        left = set(unscanned)
+        done_after = sorted(name for name in job_names + done_earlier if name > next_job and name not in left)
+        cursor = new_cursor(collector, aggregators, next_job, done_after, part)
+    return Collection(aggregators, run_count, finished, published), cursor
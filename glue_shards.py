@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from glue_collector import aggregator_from_spec, list_job_names_only, scan
+
+logger = logging.getLogger()
+
+# Coordinator/worker mode for large fleets. With GLUE_SHARDS > 1 the
+# coordinator lists job names, splits them into stable hash shards and has a
+# worker scan each shard. The workers' partial aggregates are merged before
+# anything is published.
+SHARDS = int(os.getenv('GLUE_SHARDS', '1'))
+# 'lambda' invokes GLUE_SHARD_FUNCTION (default: this function) once per
+# shard, 'process' runs the shards in a local process pool
+SHARD_TRANSPORT = os.getenv('GLUE_SHARD_TRANSPORT', 'lambda')
+SHARD_FUNCTION = os.getenv('GLUE_SHARD_FUNCTION')
+MAX_PROCESSES = int(os.getenv('GLUE_SHARD_PROCESSES', str(os.cpu_count() or 1)))
+
+SHARD_EVENT_KEY = 'glue_shard'
+
+
+def shard_of(job_name, shards):
+    # crc32 rather than hash(), which is salted per process
+    return zlib.crc32(job_name.encode()) % shards
+
+
+def split_shards(job_names, shards):
+    split = [[] for _ in range(shards)]
+    for job_name in job_names:
+        split[shard_of(job_name, shards)].append(job_name)
+    return split
+
+
+def collect_shard(request, glue_client, state_store=None):
+    # Worker side: scan one shard and return the partial aggregates
+    aggregators = [aggregator_from_spec(spec) for spec in request['aggregators']]
+    run_count = scan(glue_client, aggregators, state_store=state_store, job_names=request['job_names'])
+    return {
+        'shard': request['shard'],
+        'runs': run_count,
+        'partials': [aggregator.partial() for aggregator in aggregators],
+    }
+
+
+def _init_process():
+    # Forked pool processes must not reuse the coordinator's connections
+    from bootstrap import reset_clients
+    reset_clients()
+
+
+def _collect_shard_in_process(request):
+    # Entry point in a pool process, which builds its own clients
+    from bootstrap import get_client
+    from glue_state import open_state_store
+    return collect_shard(request, get_client('glue'), open_state_store())
+
+
+def run_in_processes(requests):
+    with ProcessPoolExecutor(max_workers=max(1, min(MAX_PROCESSES, len(requests))),
+                             initializer=_init_process) as executor:
+        futures = [executor.submit(_collect_shard_in_process, request) for request in requests]
+        for request, future in zip(requests, futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                logger.error(f"Glue shard {request['shard']} failed: {str(e)}")
+
+
+def run_in_lambda(requests, function_name):
+    from bootstrap import get_client
+    lambda_client = get_client('lambda')
+
+    def invoke(request):
+        response = lambda_client.invoke(FunctionName=function_name, InvocationType='RequestResponse',
+                                        Payload=json.dumps({SHARD_EVENT_KEY: request}).encode())
+        payload = json.loads(response['Payload'].read())
+        if response.get('FunctionError'):
+            raise RuntimeError(payload.get('errorMessage', response['FunctionError']))
+        return payload
+
+    with ThreadPoolExecutor(max_workers=max(1, len(requests))) as executor:
+        futures = [executor.submit(invoke, request) for request in requests]
+        for request, future in zip(requests, futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                logger.error(f"Glue shard {request['shard']} failed: {str(e)}")
+
+
+def fan_out(glue_client, aggregators, shards=SHARDS, transport=SHARD_TRANSPORT, function_name=None):
+    # Coordinator side: shard the fleet, collect every shard and merge the
+    # partials into `aggregators`. Returns the run count and failed shards.
+    from glue_fetcher import throttled_client
+
+    job_names = list_job_names_only(throttled_client(glue_client))
+    specs = [aggregator.spec() for aggregator in aggregators]
+    requests = [{'shard': i, 'job_names': names, 'aggregators': specs}
+                for i, names in enumerate(split_shards(job_names, shards)) if names]
+
+    if transport == 'process':
+        results = run_in_processes(requests)
+    elif transport == 'lambda':
+        results = run_in_lambda(requests, SHARD_FUNCTION or function_name)
+    else:
+        raise ValueError(f"Unsupported shard transport: {transport}")
+
+    run_count = 0
+    done = set()
+    for result in results:
+        done.add(result['shard'])
+        run_count += result['runs']
+        for aggregator, partial in zip(aggregators, result['partials']):
+            aggregator.merge(partial)
+
+    failed = sorted({request['shard'] for request in requests} - done)
+    logger.info(f"Merged {len(done)} of {len(requests)} Glue shards over {len(job_names)} jobs, {run_count} runs.")
+    return run_count, failed
@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from glue_collector import IN_FLIGHT_STATES, JobRun, iter_job_runs, job_run_from_api
+
+logger = logging.getLogger()
+
+# Where incremental scan state lives, e.g. sqlite:///tmp/glue-state.db or
+# dynamodb://glue-metrics-state. Unset means every tick scans from scratch.
+STATE_STORE_ENV = 'GLUE_STATE_STORE'
+
+# Once a job has a watermark only a few new runs are expected per tick
+INCREMENTAL_PAGE_SIZE = 25
+
+# DynamoDB global secondary index on the string attribute 'grp', projecting
+# all attributes, behind get_group()
+GROUP_INDEX = 'grp-index'
+
+
+class StateStore:
+    # Key/value store for per-job scan state. Values are JSON-able dicts.
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    # Items can also be put under a group and read back a group at a time,
+    # so writers never have to rewrite a shared document
+
+    def put_in_group(self, group, key, value):
+        raise NotImplementedError
+
+    def get_group(self, group):
+        # {key: value} of the items put under group
+        raise NotImplementedError
+
+    def delete_group(self, group):
+        for key in self.get_group(group):
+            self.delete(key)
+
+
+class SqliteStateStore(StateStore):
+    # Local file backend, used for tests and local runs. The scan calls it
+    # from several threads, so access to the connection is serialised.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, grp TEXT)')
+        if 'grp' not in [row[1] for row in self.connection.execute('PRAGMA table_info(state)')]:
+            self.connection.execute('ALTER TABLE state ADD COLUMN grp TEXT')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS state_grp ON state (grp)')
+        self.connection.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+            self.connection.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.connection.execute('DELETE FROM state WHERE key = ?', (key,))
+            self.connection.commit()
+
+    def put_in_group(self, group, key, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO state (key, value, grp) VALUES (?, ?, ?)',
+                                    (key, json.dumps(value), group))
+            self.connection.commit()
+
+    def get_group(self, group):
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM state WHERE grp = ?', (group,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def delete_group(self, group):
+        with self.lock:
+            self.connection.execute('DELETE FROM state WHERE grp = ?', (group,))
+            self.connection.commit()
+
+
+class DynamoDBStateStore(StateStore):
+    # Backend over a DynamoDB table with a string partition key 'pk'. Uses
+    # the low-level client, which unlike boto3 resources is safe to share
+    # between the scan's worker threads.
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client
+
+    def _client(self):
+        if self.client is None:
+            from bootstrap import get_client
+            self.client = get_client('dynamodb')
+        return self.client
+
+    def get(self, key):
+        item = self._client().get_item(TableName=self.table_name, Key={'pk': {'S': key}}).get('Item')
+        return json.loads(item['value']['S']) if item else None
+
+    def put(self, key, value):
+        self._client().put_item(TableName=self.table_name, Item={'pk': {'S': key}, 'value': {'S': json.dumps(value)}})
+
+    def delete(self, key):
+        self._client().delete_item(TableName=self.table_name, Key={'pk': {'S': key}})
+
+    def put_in_group(self, group, key, value):
+        self._client().put_item(TableName=self.table_name,
+                                Item={'pk': {'S': key}, 'value': {'S': json.dumps(value)}, 'grp': {'S': group}})
+
+    def get_group(self, group):
+        items = {}
+        kwargs = {
+            'TableName': self.table_name,
+            'IndexName': GROUP_INDEX,
+            'KeyConditionExpression': 'grp = :grp',
+            'ExpressionAttributeValues': {':grp': {'S': group}},
+        }
+        while True:
+            response = self._client().query(**kwargs)
+            for item in response.get('Items', []):
+                items[item['pk']['S']] = json.loads(item['value']['S'])
+            if 'LastEvaluatedKey' not in response:
+                return items
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def open_state_store(uri=None):
+    uri = uri or os.getenv(STATE_STORE_ENV)
+    if not uri:
+        return None
+
+    if uri.startswith('sqlite://'):
+        return SqliteStateStore(uri[len('sqlite://'):])
+    if uri.startswith('dynamodb://'):
+        return DynamoDBStateStore(uri[len('dynamodb://'):])
+
+    raise ValueError(f"Unsupported state store: {uri}")
+
+
+def job_run_to_item(run):
+    item = run._asdict()
+    item['started_on'] = run.started_on.isoformat()
+    item['completed_on'] = run.completed_on.isoformat() if run.completed_on else None
+    return item
+
+
+def job_run_from_item(item):
+    item = dict(item)
+    item['started_on'] = datetime.fromisoformat(item['started_on'])
+    if item['completed_on']:
+        item['completed_on'] = datetime.fromisoformat(item['completed_on'])
+    return JobRun(**item)
+
+
+class JobState:
+    # What we remember about a job between invocations: the newest StartedOn
+    # seen, the runs still inside the metric windows and which of them are
+    # unfinished.
+
+    def __init__(self, watermark=None, runs=None):
+        self.watermark = watermark
+        self.runs = runs or {}
+
+    @property
+    def in_flight(self):
+        return [run_id for run_id, run in self.runs.items() if run.state in IN_FLIGHT_STATES]
+
+    def update(self, run):
+        self.runs[run.run_id] = run
+        if self.watermark is None or run.started_on > self.watermark:
+            self.watermark = run.started_on
+
+    def prune(self, start_time):
+        self.runs = {run_id: run for run_id, run in self.runs.items() if run.started_on >= start_time}
+
+    @classmethod
+    def load(cls, store, job_name):
+        value = store.get(job_name)
+        if not value:
+            return cls()
+        runs = {item['run_id']: job_run_from_item(item) for item in value['runs']}
+        return cls(datetime.fromisoformat(value['watermark']), runs)
+
+    def save(self, store, job_name):
+        store.put(job_name, {
+            'watermark': self.watermark.isoformat(),
+            'in_flight': self.in_flight,
+            'runs': [job_run_to_item(run) for run in self.runs.values()],
+        })
+
+
+def iter_job_runs_incremental(glue_client, store, job_name, start_time, end_time):
+    # Yield the job's runs within [start_time, end_time] like iter_job_runs,
+    # but only fetch runs newer than the stored watermark and only re-poll
+    # the runs that were unfinished last time.
+    state = JobState.load(store, job_name)
+    changed = False
+
+    if state.watermark is None:
+        new_runs = iter_job_runs(glue_client, job_name, start_time, end_time)
+    else:
+        new_runs = iter_job_runs(glue_client, job_name, max(start_time, state.watermark), end_time,
+                                 page_size=INCREMENTAL_PAGE_SIZE)
+
+    in_flight = set(state.in_flight)
+    for run in new_runs:
+        if state.runs.get(run.run_id) != run:
+            state.update(run)
+            changed = True
+        in_flight.discard(run.run_id)
+
+    for run_id in in_flight:
+        try:
+            response = glue_client.get_job_run(JobName=job_name, RunId=run_id)
+        except glue_client.exceptions.EntityNotFoundException:
+            logger.warning(f"Job run {run_id} of {job_name} no longer exists, dropping it.")
+            del state.runs[run_id]
+            changed = True
+            continue
+        state.update(job_run_from_api(job_name, response['JobRun']))
+        changed = True
+
+    run_count = len(state.runs)
+    state.prune(start_time)
+    changed = changed or len(state.runs) != run_count
+
+    if changed and state.watermark is not None:
+        state.save(store, job_name)
+
+    for run in state.runs.values():
+        if start_time <= run.started_on <= end_time:
+            yield run
@@ -0,0 +1,224 @@
+import bisect
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Upper bounds (ms) of the latency histogram buckets
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+THROTTLE_ERROR_CODES = {'Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded'}
+
+# Set COLLECTOR_PROFILE=true to run the handler under cProfile. The stats are
+# dumped to COLLECTOR_PROFILE_PATH (default /tmp/<collector>.prof) and the
+# top entries logged.
+PROFILE = os.getenv('COLLECTOR_PROFILE', 'false').lower() == 'true'
+PROFILE_PATH = os.getenv('COLLECTOR_PROFILE_PATH')
+PROFILE_TOP = 25
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latency_sum_ms = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+
+class Instrumentation:
+    # Call counts, latency histograms, retries, throttles and bytes per
+    # "service.Operation", for one invocation
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.started = time.monotonic()
+
+    def record(self, operation, latency_ms, error_code=None, retries=0, size=0):
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            stats.calls += 1
+            stats.latency_sum_ms += latency_ms
+            stats.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+            stats.retries += retries
+            stats.bytes += size
+            if error_code is not None:
+                stats.errors += 1
+                if error_code in THROTTLE_ERROR_CODES:
+                    stats.throttles += 1
+
+    def summary(self):
+        with self.lock:
+            return {operation: {
+                'calls': stats.calls,
+                'errors': stats.errors,
+                'throttles': stats.throttles,
+                'retries': stats.retries,
+                'bytes': stats.bytes,
+                'avg_ms': round(stats.latency_sum_ms / stats.calls, 2) if stats.calls else 0,
+            } for operation, stats in self.operations.items()}
+
+    def metric_data(self, collector):
+        # Collector.* datapoints. Latency is sent as Values/Counts of the
+        # bucket upper bounds so CloudWatch can still give percentiles.
+        metric_data = [{
+            'MetricName': 'Collector.Duration',
+            'Dimensions': [{'Name': 'Collector', 'Value': collector}],
+            'Value': (time.monotonic() - self.started) * 1000,
+            'Unit': 'Milliseconds'
+        }]
+
+        with self.lock:
+            operations = list(self.operations.items())
+
+        for operation, stats in operations:
+            dimensions = [{'Name': 'Collector', 'Value': collector}, {'Name': 'Operation', 'Value': operation}]
+            for metric_name, value, unit in [
+                ('Collector.ApiCalls', stats.calls, 'Count'),
+                ('Collector.ApiErrors', stats.errors, 'Count'),
+                ('Collector.ApiThrottles', stats.throttles, 'Count'),
+                ('Collector.ApiRetries', stats.retries, 'Count'),
+                ('Collector.ApiBytes', stats.bytes, 'Bytes'),
+            ]:
+                metric_data.append({'MetricName': metric_name, 'Dimensions': dimensions, 'Value': value, 'Unit': unit})
+
+            bounds = LATENCY_BUCKETS_MS + [LATENCY_BUCKETS_MS[-1] * 2]
+            buckets = [(bound, count) for bound, count in zip(bounds, stats.latency_buckets) if count]
+            metric_data.append({
+                'MetricName': 'Collector.ApiLatency',
+                'Dimensions': dimensions,
+                'Values': [bound for bound, _ in buckets],
+                'Counts': [count for _, count in buckets],
+                'Unit': 'Milliseconds'
+            })
+
+        return metric_data
+
+
+instrumentation = Instrumentation()
+
+
+class InstrumentedClient:
+    # Times every call made through a boto3 client
+
+    def __init__(self, client, service, instr=instrumentation):
+        self._client = client
+        self._service = service
+        self._instr = instr
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or not callable(attribute) or name in ('get_paginator', 'get_waiter', 'can_paginate'):
+            return attribute
+
+        operation = f"{self._service}.{''.join(part.title() for part in name.split('_'))}"
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                response = attribute(*args, **kwargs)
+            except Exception as e:
+                error = getattr(e, 'response', None) or {}
+                self._instr.record(operation, (time.perf_counter() - start) * 1000,
+                                   error_code=error.get('Error', {}).get('Code', type(e).__name__),
+                                   retries=error.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+                raise
+
+            metadata = response.get('ResponseMetadata', {}) if isinstance(response, dict) else {}
+            self._instr.record(operation, (time.perf_counter() - start) * 1000,
+                               retries=metadata.get('RetryAttempts', 0),
+                               size=int(metadata.get('HTTPHeaders', {}).get('content-length', 0)))
+            return response
+
+        return call
+
+
+def instrument_client(client, service, instr=instrumentation):
+    return InstrumentedClient(client, service, instr)
+
+
+def http_operation(method, url):
+    # Collapse ids in Airflow REST paths so each route is one operation
+    path = re.sub(r'^[a-z]+://[^/]+', '', url).split('?')[0]
+    path = re.sub(r'/dags/[^/~]+', '/dags/{dag_id}', path)
+    path = re.sub(r'/dagRuns/[^/~]+', '/dagRuns/{dag_run_id}', path)
+    return f"http.{method.upper()} {path}"
+
+
+def instrument_session(session, instr=instrumentation):
+    # Times every request made through a requests.Session
+    request = session.request
+
+    @functools.wraps(request)
+    def timed_request(method, url, *args, **kwargs):
+        operation = http_operation(method, url)
+        start = time.perf_counter()
+        try:
+            response = request(method, url, *args, **kwargs)
+        except Exception as e:
+            instr.record(operation, (time.perf_counter() - start) * 1000, error_code=type(e).__name__)
+            raise
+
+        error_code = None
+        if response.status_code == 429:
+            error_code = 'Throttling'
+        elif response.status_code >= 400:
+            error_code = str(response.status_code)
+        instr.record(operation, (time.perf_counter() - start) * 1000, error_code=error_code,
+                     size=int(response.headers.get('Content-Length', 0)))
+        return response
+
+    session.request = timed_request
+    return session
+
+
+def instrumented_handler(collector, namespace, publisher, instr=instrumentation):
+    # Wraps a lambda_handler: resets the counters, optionally profiles the
+    # call, and publishes the Collector.* summary when it finishes
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            instr.reset()
+            profiler = cProfile.Profile() if PROFILE else None
+            try:
+                if profiler is not None:
+                    return profiler.runcall(handler, event, context)
+                return handler(event, context)
+            finally:
+                if profiler is not None:
+                    dump_profile(profiler, collector)
+                logger.info(f"Collector {collector} API summary: {instr.summary()}")
+                try:
+                    publisher.put(namespace, instr.metric_data(collector))
+                    publisher.flush()
+                except Exception as e:
+                    logger.error(f"Failed to publish collector metrics: {str(e)}")
+
+        return wrapper
+
+    return decorator
+
+
+def dump_profile(profiler, collector):
+    path = PROFILE_PATH or f"/tmp/{collector}.prof"
+    profiler.dump_stats(path)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    logger.info(f"Profile written to {path}\n{output.getvalue()}")
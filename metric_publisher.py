@@ -0,0 +1,386 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from blob_store import open_blob_store
+
+logger = logging.getLogger()
+
+# PutMetricData limits
+MAX_DATUMS_PER_REQUEST = 1000
+MAX_REQUEST_BYTES = 1000000  # HTTP POST body limit
+MAX_VALUES_PER_DATUM = 150
+REQUEST_OVERHEAD_BYTES = 200  # Action, Version and Namespace fields
+
+# Embedded Metric Format limits per log line
+EMF_MAX_METRICS = 100
+EMF_MAX_VALUES = 100
+
+# 'cloudwatch' calls PutMetricData, 'emf' writes Embedded Metric Format to stdout
+METRICS_SINK = os.getenv('METRICS_SINK', 'cloudwatch')
+
+# Change-only publishing: with METRICS_LAST_VALUE_URI (a local directory or
+# s3://bucket/prefix) set, repeated zeros of the IDLE_COUNT_METRICS series
+# and unchanged values of the CHANGE_ONLY_GAUGES series are skipped, except
+# for a heartbeat every METRICS_HEARTBEAT_TICKS ticks. Both are comma
+# separated metric name prefixes.
+LAST_VALUE_URI = os.getenv('METRICS_LAST_VALUE_URI')
+IDLE_COUNT_METRICS = tuple(prefix for prefix in os.getenv('IDLE_COUNT_METRICS', 'JobStatusCount,DAGRuns.').split(',') if prefix)
+CHANGE_ONLY_GAUGES = tuple(prefix for prefix in os.getenv('CHANGE_ONLY_GAUGES', '').split(',') if prefix)
+HEARTBEAT_TICKS = int(os.getenv('METRICS_HEARTBEAT_TICKS', '12'))
+
+MAX_WORKERS = 4  # Parallel put_metric_data calls per flush
+RETRIES = 3
+RETRYABLE_ERROR_CODES = {'Throttling', 'ThrottlingException', 'InternalServiceFault', 'ServiceUnavailable'}
+
+
+def _flatten(prefix, value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(f"{prefix}.{key}", item)
+    elif isinstance(value, list):
+        for i, item in enumerate(value, 1):
+            yield from _flatten(f"{prefix}.member.{i}", item)
+    else:
+        yield prefix, value
+
+
+def datum_size(datum):
+    # Bytes the datum adds to a form encoded request, numbered as the
+    # largest possible member index so the estimate never runs low
+    size = 0
+    for key, value in _flatten(f"MetricData.member.{MAX_DATUMS_PER_REQUEST}", datum):
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        size += len(key) + len(quote(str(value), safe='')) + 2
+    return size
+
+
+def _series_key(datum):
+    dimensions = tuple((d['Name'], d['Value']) for d in datum.get('Dimensions', []))
+    return (datum['MetricName'], dimensions, datum.get('Unit'), datum.get('Timestamp'),
+            datum.get('StorageResolution'))
+
+
+def collapse(metric_data):
+    # Merge single value datapoints of the same series into Values/Counts
+    series = OrderedDict()
+    collapsed = []
+
+    for datum in metric_data:
+        if 'Value' not in datum:
+            collapsed.append(datum)
+            continue
+        series.setdefault(_series_key(datum), (datum, Counter()))[1][datum['Value']] += 1
+
+    for datum, counts in series.values():
+        if len(counts) == 1 and sum(counts.values()) == 1:
+            collapsed.append(datum)
+            continue
+
+        base = {key: value for key, value in datum.items() if key != 'Value'}
+        items = list(counts.items())
+        for i in range(0, len(items), MAX_VALUES_PER_DATUM):
+            chunk = items[i:i + MAX_VALUES_PER_DATUM]
+            collapsed.append(dict(base, Values=[value for value, _ in chunk], Counts=[count for _, count in chunk]))
+
+    return collapsed
+
+
+def pack(metric_data):
+    # Split datapoints into the fewest requests under the count and size limits
+    requests = []
+    current = []
+    current_size = REQUEST_OVERHEAD_BYTES
+
+    for datum in metric_data:
+        size = datum_size(datum)
+        if current and (len(current) >= MAX_DATUMS_PER_REQUEST or current_size + size > MAX_REQUEST_BYTES):
+            requests.append(current)
+            current = []
+            current_size = REQUEST_OVERHEAD_BYTES
+        current.append(datum)
+        current_size += size
+
+    if current:
+        requests.append(current)
+    return requests
+
+
+class MetricPublisher:
+    # Buffers put_metric_data calls and sends them as few, full requests.
+    # Each put() stands for one call the lambda would have made on its own,
+    # which is what calls_saved is measured against.
+
+    def __init__(self, cloudwatch_client, max_workers=MAX_WORKERS, retries=RETRIES):
+        self.cloudwatch_client = cloudwatch_client
+        self.max_workers = max_workers
+        self.retries = retries
+        self.buffer = OrderedDict()
+        self.put_calls = 0
+        self.lock = threading.Lock()
+
+    def put(self, namespace, metric_data):
+        with self.lock:
+            self.buffer.setdefault(namespace, []).extend(metric_data)
+            self.put_calls += 1
+
+    def _send(self, namespace, metric_data):
+        attempt = 0
+        while True:
+            try:
+                self.cloudwatch_client.put_metric_data(Namespace=namespace, MetricData=metric_data)
+                return True
+            except Exception as e:
+                code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+                if code not in RETRYABLE_ERROR_CODES or attempt >= self.retries:
+                    logger.error(f"Failed to put {len(metric_data)} CloudWatch metrics to {namespace}: {str(e)}")
+                    return False
+            attempt += 1
+            time.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, OrderedDict()
+            put_calls, self.put_calls = self.put_calls, 0
+
+        datapoints = sum(len(metric_data) for metric_data in buffer.values())
+        requests = [(namespace, chunk) for namespace, metric_data in buffer.items()
+                    for chunk in pack(collapse(metric_data))]
+
+        if len(requests) > 1 and self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(requests))) as executor:
+                results = list(executor.map(lambda request: self._send(*request), requests))
+        else:
+            results = [self._send(*request) for request in requests]
+
+        stats = {
+            'datapoints': datapoints,
+            'requests': len(requests),
+            'failed_requests': results.count(False),
+            'calls_saved': max(0, put_calls - len(requests)),
+        }
+        logger.info(f"Published {datapoints} datapoints in {len(requests)} put_metric_data calls "
+                    f"({stats['calls_saved']} calls saved, {stats['failed_requests']} failed).")
+        return stats
+
+
+def _epoch_millis(timestamp):
+    return int(timestamp.timestamp() * 1000) if timestamp is not None else int(time.time() * 1000)
+
+
+class EmfPublisher:
+    # Same interface as MetricPublisher, but writes the datapoints as
+    # CloudWatch Embedded Metric Format log lines instead of calling the API.
+    # EMF has no statistic sets, so datapoints with StatisticValues go to the
+    # fallback publisher when one is given.
+
+    def __init__(self, stream=None, fallback=None):
+        self.stream = stream or sys.stdout
+        self.fallback = fallback
+        self.buffer = OrderedDict()
+        self.put_calls = 0
+        self.lock = threading.Lock()
+
+    def put(self, namespace, metric_data):
+        with self.lock:
+            self.buffer.setdefault(namespace, []).extend(metric_data)
+            self.put_calls += 1
+
+    def _lines(self, namespace, metric_data):
+        # One line per (dimensions, timestamp), holding up to EMF_MAX_METRICS
+        # metrics with up to EMF_MAX_VALUES values each
+        groups = OrderedDict()
+        for datum in metric_data:
+            dimensions = tuple((d['Name'], d['Value']) for d in datum.get('Dimensions', []))
+            metrics = groups.setdefault((dimensions, datum.get('Timestamp')), OrderedDict())
+            unit, values = metrics.setdefault(datum['MetricName'], (datum.get('Unit', 'None'), []))
+            if 'Value' in datum:
+                values.append(datum['Value'])
+            else:
+                for value, count in zip(datum['Values'], datum.get('Counts', [1] * len(datum['Values']))):
+                    values.extend([value] * int(count))
+
+        for (dimensions, timestamp), metrics in groups.items():
+            metric_values = [(name, unit, values[i:i + EMF_MAX_VALUES])
+                             for name, (unit, values) in metrics.items()
+                             for i in range(0, len(values), EMF_MAX_VALUES)]
+
+            # A metric name can only appear once per line
+            while metric_values:
+                line_metrics, seen, remaining = [], set(), []
+                for metric in metric_values:
+                    if metric[0] in seen or len(line_metrics) >= EMF_MAX_METRICS:
+                        remaining.append(metric)
+                    else:
+                        seen.add(metric[0])
+                        line_metrics.append(metric)
+                metric_values = remaining
+
+                line = {
+                    '_aws': {
+                        'Timestamp': _epoch_millis(timestamp),
+                        'CloudWatchMetrics': [{
+                            'Namespace': namespace,
+                            'Dimensions': [[name for name, _ in dimensions]],
+                            'Metrics': [{'Name': name, 'Unit': unit} for name, unit, _ in line_metrics],
+                        }],
+                    },
+                }
+                line.update(dimensions)
+                for name, _, values in line_metrics:
+                    line[name] = values[0] if len(values) == 1 else values
+                yield line
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, OrderedDict()
+            put_calls, self.put_calls = self.put_calls, 0
+
+        datapoints = 0
+        lines = 0
+        for namespace, metric_data in buffer.items():
+            datapoints += len(metric_data)
+            statistic_sets = [datum for datum in metric_data if 'StatisticValues' in datum]
+            if statistic_sets:
+                if self.fallback is not None:
+                    self.fallback.put(namespace, statistic_sets)
+                else:
+                    logger.warning(f"Dropping {len(statistic_sets)} StatisticValues datapoints, EMF can't carry them.")
+
+            for line in self._lines(namespace, [datum for datum in metric_data if 'StatisticValues' not in datum]):
+                self.stream.write(json.dumps(line) + '\n')
+                lines += 1
+        self.stream.flush()
+
+        stats = {'datapoints': datapoints, 'requests': 0, 'failed_requests': 0, 'calls_saved': put_calls, 'emf_lines': lines}
+        if self.fallback is not None:
+            fallback_stats = self.fallback.flush()
+            stats['requests'] = fallback_stats['requests']
+            stats['failed_requests'] = fallback_stats['failed_requests']
+            stats['calls_saved'] = max(0, put_calls - fallback_stats['requests'])
+
+        logger.info(f"Wrote {datapoints} datapoints as {lines} EMF log lines.")
+        return stats
+
+
+class ChangeOnlyPublisher:
+    # Same interface again, in front of another publisher. Datapoints are
+    # dropped when they repeat the value last published for their
+    # (namespace, metric, dimensions), unless heartbeat_ticks ticks have
+    # passed since it was sent. Count series (count_prefixes) are counts per
+    # window, where a repeated 1 is a new run, so only their repeated zeros
+    # are dropped; gauge series (gauge_prefixes) drop any repeated value. A
+    # tick is a flush that saw such series. Datapoints with their own
+    # Timestamp (backfills) always go through.
+    #
+    # The last values are one JSON document in a blob store, loaded on first
+    # use and kept across warm invocations. It is only saved after a flush
+    # where every request succeeded, so a lost datapoint is sent again.
+
+    def __init__(self, publisher, store, key, count_prefixes=IDLE_COUNT_METRICS, gauge_prefixes=CHANGE_ONLY_GAUGES,
+                 heartbeat_ticks=HEARTBEAT_TICKS):
+        self.publisher = publisher
+        self.store = store
+        self.key = key
+        self.count_prefixes = count_prefixes
+        self.gauge_prefixes = gauge_prefixes
+        self.heartbeat_ticks = heartbeat_ticks
+        self.state = None
+        self.pending = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def _state(self):
+        if self.state is None:
+            try:
+                self.state = self.store.get_json(self.key)
+            except Exception as e:
+                logger.error(f"Failed to load last metric values from {self.key}: {str(e)}")
+            self.state = self.state or {'tick': 0, 'series': {}}
+        return self.state
+
+    def _series(self, namespace, datum):
+        # (cache key, is_gauge) of a datum that may be suppressed, otherwise None
+        if 'Value' not in datum or 'Timestamp' in datum:
+            return None
+        if datum['MetricName'].startswith(self.gauge_prefixes):
+            is_gauge = True
+        elif datum['MetricName'].startswith(self.count_prefixes):
+            is_gauge = False
+        else:
+            return None
+        dimensions = ','.join(f"{d['Name']}={d['Value']}" for d in datum.get('Dimensions', []))
+        return f"{namespace}|{datum['MetricName']}|{dimensions}", is_gauge
+
+    def put(self, namespace, metric_data):
+        kept = []
+        with self.lock:
+            state = self._state()
+            for datum in metric_data:
+                kind = self._series(namespace, datum)
+                if kind is not None:
+                    series, is_gauge = kind
+                    last = state['series'].get(series)
+                    repeated = (last is not None and last[0] == datum['Value']
+                                and state['tick'] - last[1] < self.heartbeat_ticks)
+                    if repeated and (is_gauge or datum['Value'] == 0):
+                        self.suppressed += 1
+                        continue
+                    self.pending[series] = datum['Value']
+                kept.append(datum)
+        self.publisher.put(namespace, kept)
+
+    def flush(self):
+        stats = self.publisher.flush()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            suppressed, self.suppressed = self.suppressed, 0
+            if pending or suppressed:
+                self._commit(pending, stats['failed_requests'] == 0)
+
+        stats['suppressed'] = suppressed
+        logger.info(f"Suppressed {suppressed} unchanged datapoints.")
+        return stats
+
+    def _commit(self, pending, published):
+        state = self._state()
+        if not published:
+            logger.warning("Some metrics failed to publish, keeping the previous last values.")
+            return
+
+        tick = state['tick']
+        state['series'].update((series, [value, tick]) for series, value in pending.items())
+        # A series not sent for longer than a heartbeat is no longer published
+        state['series'] = {series: last for series, last in state['series'].items()
+                           if tick - last[1] <= self.heartbeat_ticks}
+        state['tick'] = tick + 1
+        try:
+            self.store.put_json(self.key, state)
+        except Exception as e:
+            logger.error(f"Failed to save last metric values to {self.key}: {str(e)}")
+
+
+def create_publisher(cloudwatch_client, sink=None):
+    # Publisher for the sink chosen by METRICS_SINK, behind a
+    # ChangeOnlyPublisher when METRICS_LAST_VALUE_URI is set
+    sink = sink or METRICS_SINK
+    if sink == 'emf':
+        publisher = EmfPublisher(fallback=MetricPublisher(cloudwatch_client))
+    elif sink == 'cloudwatch':
+        publisher = MetricPublisher(cloudwatch_client)
+    else:
+        raise ValueError(f"Unsupported metrics sink: {sink}")
+
+    store = open_blob_store(LAST_VALUE_URI)
+    if store is not None:
+        key = f"last-values/{os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'local')}.json"
+        publisher = ChangeOnlyPublisher(publisher, store, key)
+    return publisher
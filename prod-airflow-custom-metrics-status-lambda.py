@@ -1,30 +1,80 @@
-import boto3
 import requests
 import logging
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import json
 import os
+import queue
+import threading
+import time
+from requests.adapters import HTTPAdapter
+
+from blob_store import open_blob_store
+from bootstrap import get_client, lazy_client
+from deadline import MAX_CONTINUATIONS, Deadline, hand_off
+from instrumentation import instrument_session, instrumented_handler
+from metric_publisher import create_publisher
+from run_export import EXPORT_URI, RecordWriter, export_name
 
 # Hardcoded environment details
 REGION = "ap-southeast-2"
 ENV_NAMES = json.loads(os.getenv("ENV_NAMES", "[]"))  # Load ENV_NAMES from Lambda environment variable
-MAX_WORKERS = 10  # Number of parallel workers
+MAX_WORKERS = 10  # Number of parallel workers per environment
+ENV_CONCURRENCY = int(os.getenv("ENV_CONCURRENCY", "4"))  # Environments collected at the same time
+ENV_TIMEOUT = int(os.getenv("ENV_TIMEOUT", "600"))  # Seconds one environment may take before it is abandoned
+DAG_INVENTORY_MAX_AGE = int(os.getenv("DAG_INVENTORY_MAX_AGE", "3600"))  # Seconds before the DAG list is re-downloaded anyway
+INCLUDE_PAUSED_DAGS = os.getenv("INCLUDE_PAUSED_DAGS", "false").lower() == "true"  # Also query paused/inactive DAGs
+WEB_SCHEME = os.getenv("MWAA_WEB_SCHEME", "https")  # Only changed to point at a local fake web server
+SESSION_TTL = int(os.getenv("MWAA_SESSION_TTL", "1800"))  # Seconds to reuse a web server session cookie
+REQUEST_TIMEOUT = 30  # Seconds per Airflow API request
+DAG_RUNS_MODE = os.getenv("DAG_RUNS_MODE", "batch")  # "batch" uses POST /dags/~/dagRuns/list, "per_dag" one GET per DAG
+DAG_IDS_PER_REQUEST = 100  # DAG ids sent in one batch request
+PAGE_LIMIT = 100  # Airflow's default maximum page size
+TASK_INSTANCE_METRICS = os.getenv("TASK_INSTANCE_METRICS", "false").lower() == "true"  # Also publish task duration and queue latency
+TASK_INSTANCE_MAX_REQUESTS = int(os.getenv("TASK_INSTANCE_MAX_REQUESTS", "0"))  # Per environment and tick; 0 means as many as the DAG runs took
+# Fields of the filtered DAG runs, as exported when RUN_EXPORT_URI is set
+RUN_EXPORT_FIELDS = [('environment', 'string'), ('dag_id', 'string'), ('execution_date', 'string'),
+                     ('external_trigger', 'bool'), ('start_date', 'string'), ('state', 'string')]
+CONTINUATION_EVENT_KEY = "airflow_continuation"  # Event key of the rest of a collection that ran out of time
+MAX_QUEUED_WINDOWS = int(os.getenv("MAX_QUEUED_WINDOWS", "3"))  # Windows that may wait behind an unfinished collection
+
+# CloudWatch client, created on first use
+cloudwatch = lazy_client('cloudwatch', region_name=REGION)
+publisher = create_publisher(cloudwatch)
+
+# One pooled, keep-alive HTTP session shared by all workers and environments
+http = requests.Session()
+adapter = HTTPAdapter(pool_connections=max(MAX_WORKERS, len(ENV_NAMES)), pool_maxsize=MAX_WORKERS)
+http.mount("https://", adapter)
+http.mount("http://", adapter)
+instrument_session(http)
+
+# Web server sessions per environment, kept across warm invocations
+sessions = {}  # env_name -> (web_server_host_name, session_cookie, expires_at)
+session_locks = {}  # env_name -> lock, so environments log in independently
+session_locks_lock = threading.Lock()
+batch_supported = {}  # env_name -> whether the web server has the batch endpoint
 
-# Initialize CloudWatch client
-cloudwatch = boto3.client('cloudwatch', region_name=REGION)
+# DAG inventory per environment, kept across warm invocations and optionally
+# in a local directory or s3://bucket/prefix given by DAG_INVENTORY_URI
+dag_inventory = {}
+inventory_store = open_blob_store(os.getenv("DAG_INVENTORY_URI"))
 
-def get_session_info(region, env_name):
+def get_mwaa_client(region):
+    return get_client('mwaa', region_name=region)
+
+def login(region, env_name):
     logging.basicConfig(level=logging.INFO)
     try:
-        mwaa = boto3.client('mwaa', region_name=region)
+        mwaa = get_mwaa_client(region)
         response = mwaa.create_web_login_token(Name=env_name)
         web_server_host_name = response["WebServerHostname"]
         web_token = response["WebToken"]
 
-        login_url = f"https://{web_server_host_name}/aws_mwaa/login"
+        login_url = f"{WEB_SCHEME}://{web_server_host_name}/aws_mwaa/login"
         login_payload = {"token": web_token}
-        response = requests.post(login_url, data=login_payload, timeout=10)
+        response = http.post(login_url, data=login_payload, timeout=10)
 
         if response.status_code == 200:
             return web_server_host_name, response.cookies["session"]
@@ -38,29 +88,68 @@ def get_session_info(region, env_name):
         logging.error("An unexpected error occurred: %s", str(e))
         return None, None
 
-def list_dags(region, env_name):
-    logging.info(f"Listing all DAGs in environment {env_name} at region {region}")
+def get_session_info(region, env_name, expired_cookie=None):
+    # Log in once per environment and reuse the session cookie until it
+    # expires. Passing the cookie that was just rejected forces a re-login,
+    # unless another thread has already replaced it.
+    with session_locks_lock:
+        session_lock = session_locks.setdefault(env_name, threading.Lock())
 
+    with session_lock:
+        cached = sessions.get(env_name)
+        if cached and cached[2] > time.monotonic() and cached[1] != expired_cookie:
+            return cached[0], cached[1]
+
+        web_server_host_name, session_cookie = login(region, env_name)
+        if session_cookie:
+            sessions[env_name] = (web_server_host_name, session_cookie, time.monotonic() + SESSION_TTL)
+        else:
+            sessions.pop(env_name, None)
+        return web_server_host_name, session_cookie
+
+def airflow_request(method, region, env_name, path, **kwargs):
+    # Call an Airflow REST API path on the pooled connection, logging in
+    # again once if the session has expired (401, or a 302 to the login page)
     web_server_host_name, session_cookie = get_session_info(region, env_name)
     if not session_cookie:
         logging.error("Authentication failed, no session cookie retrieved.")
         return None
 
-    cookies = {"session": session_cookie}
-    url = f"https://{web_server_host_name}/api/v1/dags?limit=300"  # API call with limit 300
+    response = http.request(method, f"{WEB_SCHEME}://{web_server_host_name}{path}", cookies={"session": session_cookie},
+                            allow_redirects=False, timeout=REQUEST_TIMEOUT, **kwargs)
+    if response.status_code in (401, 302):
+        logging.info(f"Session for {env_name} expired, logging in again.")
+        web_server_host_name, session_cookie = get_session_info(region, env_name, expired_cookie=session_cookie)
+        if not session_cookie:
+            logging.error("Authentication failed, no session cookie retrieved.")
+            return None
+        response = http.request(method, f"{WEB_SCHEME}://{web_server_host_name}{path}", cookies={"session": session_cookie},
+                                allow_redirects=False, timeout=REQUEST_TIMEOUT, **kwargs)
+    return response
+
+def airflow_get(region, env_name, path):
+    return airflow_request("GET", region, env_name, path)
+
+def airflow_post(region, env_name, path, body):
+    return airflow_request("POST", region, env_name, path, json=body)
+
+def list_dags(region, env_name):
+    logging.info(f"Listing all DAGs in environment {env_name} at region {region}")
+
+    path = "/api/v1/dags?limit=300"  # API call with limit 300
 
     all_dags = []
-    while url:  # Pagination logic to handle large number of DAGs
+    while path:  # Pagination logic to handle large number of DAGs
         try:
-            response = requests.get(url, cookies=cookies)
+            response = airflow_get(region, env_name, path)
+            if response is None:
+                return None
             if response.status_code == 200:
                 data = response.json()
                 all_dags.extend(data['dags'])  # Append newly fetched DAGs
-                url = data.get('_links', {}).get('next', {}).get('href', None)  # Set URL to the next page of results
-                if url:
-                    url = f"https://{web_server_host_name}{url}"  # Ensure the full URL is used
-                else:
-                    break
+                path = data.get('_links', {}).get('next', {}).get('href', None)  # Path of the next page of results
+                if not path and data['dags'] and len(all_dags) < data.get('total_entries', 0):
+                    path = f"/api/v1/dags?limit=300&offset={len(all_dags)}"  # Airflow 2 pages by offset instead
             else:
                 logging.error(f"Failed to fetch DAGs: HTTP {response.status_code} - {response.text}")
                 break
@@ -71,134 +160,584 @@ def list_dags(region, env_name):
     logging.info(f"Fetched a total of {len(all_dags)} DAGs.")
     return all_dags
 
-def list_dag_runs(region, env_name, dag_id, start_time_str, end_time_str):
-    logging.info(f"Listing DAG runs for DAG {dag_id} in environment {env_name} at region {region}")
+def inventory_signature(region, env_name):
+    # [DAG count, paused DAG count] from two one DAG requests, or None.
+    # last_parsed_time isn't used: the scheduler re-parses every DAG file
+    # every 30 seconds or so, so it changes on almost every tick.
+    signature = []
+    for path in ("/api/v1/dags?limit=1", "/api/v1/dags?limit=1&paused=true"):
+        try:
+            response = airflow_get(region, env_name, path)
+            if response is None or response.status_code != 200:
+                return None
+            signature.append(response.json().get('total_entries', 0))
+        except requests.RequestException as e:
+            logging.error(f"Request failed: {str(e)}")
+            return None
+    return signature
 
-    web_server_host_name, session_cookie = get_session_info(region, env_name)
-    if not session_cookie:
-        logging.error("Authentication failed, no session cookie retrieved.")
-        return None
+def get_dag_inventory(region, env_name):
+    # The DAG list, re-downloaded only when the DAG count or the paused DAG
+    # count changed, or the cached copy is older than DAG_INVENTORY_MAX_AGE
+    cached = dag_inventory.get(env_name)
+    if cached is None and inventory_store is not None:
+        cached = inventory_store.get_json(f"dag-inventory/{env_name}.json")
 
-    cookies = {"session": session_cookie}
-    url = f"https://{web_server_host_name}/api/v1/dags/{dag_id}/dagRuns?start_date_gte={start_time_str}&end_date_lte={end_time_str}"
+    if cached is not None and time.time() - cached['fetched_at'] < DAG_INVENTORY_MAX_AGE:
+        signature = inventory_signature(region, env_name)
+        if signature is not None and signature == cached['signature']:
+            logging.info(f"DAG inventory for {env_name} unchanged, reusing {len(cached['dags'])} cached DAGs.")
+            dag_inventory[env_name] = cached
+            return cached['dags']
 
-    try:
-        response = requests.get(url, cookies=cookies)
-        if response.status_code == 200:
-            return response.json().get("dag_runs", [])
-        else:
-            logging.error(f"Failed to fetch DAG runs for {dag_id}: HTTP {response.status_code} - {response.text}")
-            return None
-    except requests.RequestException as e:
-        logging.error(f"Request to fetch DAG runs failed for {dag_id}: {str(e)}")
+    dags = list_dags(region, env_name)
+    if dags is None:
         return None
 
-def put_cloudwatch_metrics(success_count, failed_count, dag_id, env_name, env_success_count, env_failed_count):
-    try:
-        cloudwatch.put_metric_data(
-            Namespace='AmazonMWAA',
-            MetricData=[
-                {
-                    'MetricName': 'DAGRuns.Success',
-                    'Dimensions': [
-                        {'Name': 'EnvironmentName', 'Value': env_name},
-                        {'Name': 'DAG_ID', 'Value': dag_id}
-                    ],
-                    'Value': success_count,
-                    'Unit': 'Count'
-                },
-                {
-                    'MetricName': 'DAGRuns.Failed',
-                    'Dimensions': [
-                        {'Name': 'EnvironmentName', 'Value': env_name},
-                        {'Name': 'DAG_ID', 'Value': dag_id}
-                    ],
-                    'Value': failed_count,
-                    'Unit': 'Count'
-                },
-                {
-                    'MetricName': 'DAGRuns.EnvironmentSuccess',
-                    'Dimensions': [{'Name': 'EnvironmentName', 'Value': env_name}],
-                    'Value': env_success_count,
-                    'Unit': 'Count'
-                },
-                {
-                    'MetricName': 'DAGRuns.EnvironmentFailed',
-                    'Dimensions': [{'Name': 'EnvironmentName', 'Value': env_name}],
-                    'Value': env_failed_count,
-                    'Unit': 'Count'
-                }
-            ]
-        )
-        logging.info(f"Successfully published CloudWatch metrics for {dag_id}: {success_count} successes, {failed_count} failures, {env_success_count} total environment successes, {env_failed_count} total environment failures.")
-    except Exception as e:
-        logging.error(f"Failed to put CloudWatch metrics for {dag_id}: {str(e)}")
+    inventory = {
+        'signature': [len(dags), sum(1 for dag in dags if dag.get('is_paused'))],
+        'fetched_at': time.time(),
+        'dags': [{key: dag.get(key) for key in ('dag_id', 'is_paused', 'is_active')} for dag in dags],
+    }
+    dag_inventory[env_name] = inventory
+    if inventory_store is not None:
+        try:
+            inventory_store.put_json(f"dag-inventory/{env_name}.json", inventory)
+        except Exception as e:
+            logging.error(f"Failed to save DAG inventory for {env_name}: {str(e)}")
+    return inventory['dags']
+
+def active_dags(dags):
+    # Paused or inactive DAGs can't have new runs, so they aren't queried
+    # unless INCLUDE_PAUSED_DAGS is set
+    if INCLUDE_PAUSED_DAGS:
+        return dags
+    return [dag for dag in dags if not dag.get('is_paused') and dag.get('is_active', True) is not False]
+
+def iter_dag_run_pages(region, env_name, dag_id, start_time_str, end_time_str):
+    # Pages of one DAG's runs, paged so busy DAGs aren't truncated
+    logging.info(f"Listing DAG runs for DAG {dag_id} in environment {env_name} at region {region}")
+
+    offset = 0
+    while True:
+        path = (f"/api/v1/dags/{dag_id}/dagRuns?start_date_gte={start_time_str}&end_date_lte={end_time_str}"
+                f"&limit={PAGE_LIMIT}&offset={offset}")
+        try:
+            response = airflow_get(region, env_name, path)
+            if response is None:
+                return
+            if response.status_code != 200:
+                logging.error(f"Failed to fetch DAG runs for {dag_id}: HTTP {response.status_code} - {response.text}")
+                return
+        except requests.RequestException as e:
+            logging.error(f"Request to fetch DAG runs failed for {dag_id}: {str(e)}")
+            return
+
+        data = response.json()
+        page = data.get("dag_runs", [])
+        yield page
+        offset += len(page)
+        if not page or offset >= data.get("total_entries", 0):
+            return
+
+class BatchEndpointUnsupported(Exception):
+    pass
+
+def iter_dag_run_pages_batch(region, env_name, dag_ids, start_time_str, end_time_str):
+    # Pages of runs for a chunk of DAGs from POST /dags/~/dagRuns/list.
+    # Raises BatchEndpointUnsupported on Airflow versions without it.
+    offset = 0
+    while True:
+        body = {
+            "dag_ids": dag_ids,
+            "start_date_gte": start_time_str,
+            "end_date_lte": end_time_str,
+            "page_offset": offset,
+            "page_limit": PAGE_LIMIT,
+        }
+        try:
+            response = airflow_post(region, env_name, "/api/v1/dags/~/dagRuns/list", body)
+            if response is None:
+                return
+            if response.status_code in (404, 405):
+                raise BatchEndpointUnsupported(f"HTTP {response.status_code}")
+            if response.status_code != 200:
+                logging.error(f"Failed to list DAG runs in {env_name}: HTTP {response.status_code} - {response.text}")
+                return
+        except requests.RequestException as e:
+            logging.error(f"Request to list DAG runs failed in {env_name}: {str(e)}")
+            return
+
+        data = response.json()
+        page = data.get("dag_runs", [])
+        yield page
+        offset += len(page)
+        if not page or offset >= data.get("total_entries", 0):
+            return
+
+class RequestBudget:
+    # Requests an environment's task instance collection may still send,
+    # shared by its workers
+
+    def __init__(self, requests):
+        self.remaining = requests
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.remaining > 0:
+                self.remaining -= 1
+                return True
+            self.exhausted = True
+            return False
+
+def iter_task_instance_pages(region, env_name, dag_ids, start_time_str, end_time_str, budget):
+    # Pages of the task instances of a chunk of DAGs, from
+    # POST /dags/~/dagRuns/~/taskInstances/list, for the same date window as
+    # the DAG runs. Stops early once the budget is spent.
+    offset = 0
+    while budget.take():
+        body = {
+            "dag_ids": dag_ids,
+            "start_date_gte": start_time_str,
+            "end_date_lte": end_time_str,
+            "page_offset": offset,
+            "page_limit": PAGE_LIMIT,
+        }
+        try:
+            response = airflow_post(region, env_name, "/api/v1/dags/~/dagRuns/~/taskInstances/list", body)
+            if response is None:
+                return
+            if response.status_code != 200:
+                logging.error(f"Failed to list task instances in {env_name}: HTTP {response.status_code} - {response.text}")
+                return
+        except requests.RequestException as e:
+            logging.error(f"Request to list task instances failed in {env_name}: {str(e)}")
+            return
 
-def fetch_all_dag_runs(dags, region, env_name, start_time_str, end_time_str):
-    all_dag_runs = []
-    success_count = 0
-    failed_count = 0
-    env_success_count = 0
-    env_failed_count = 0
+        data = response.json()
+        page = data.get("task_instances", [])
+        yield page
+        offset += len(page)
+        if not page or offset >= data.get("total_entries", 0):
+            return
+
+def stream_pages(page_iterators):
+    # Drain page iterators on MAX_WORKERS threads into one stream of pages.
+    # The queue is bounded, so memory stays at a few pages however many runs
+    # there are, and fetching never runs far ahead of the consumer.
+    pages = queue.Queue(maxsize=MAX_WORKERS * 2)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def drain(page_iterator):
+        try:
+            for page in page_iterator:
+                if stop.is_set():
+                    return
+                put(page)
+        except Exception as e:
+            logging.error(f"Error fetching DAG runs: {str(e)}")
+        finally:
+            put(finished)
 
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(list_dag_runs, region, env_name, dag["dag_id"], start_time_str, end_time_str): dag["dag_id"] for dag in dags}
+        remaining = 0
+        for page_iterator in page_iterators:
+            executor.submit(drain, page_iterator)
+            remaining += 1
+
+        try:
+            while remaining:
+                item = pages.get()
+                if item is finished:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+def unless_expired(page_iterator, dag_ids, deadline, pending):
+    # The pages of one request unit, or none if the deadline has passed by
+    # the time a worker gets to it; its DAGs are then left pending
+    if deadline is not None and deadline.expired():
+        pending.extend(dag_ids)
+        return
+    yield from page_iterator
+
+def iter_dag_run_pages_for_env(dags, region, env_name, start_time_str, end_time_str, deadline=None, pending=None):
+    # Batch mode sends chunks of DAG ids to the batch endpoint. The first
+    # page is fetched on its own to find out whether the endpoint exists;
+    # if not, the environment falls back to one request per DAG. Units not
+    # started before the deadline add their DAG ids to pending.
+    pending = pending if pending is not None else []
+    dag_ids = [dag["dag_id"] for dag in dags]
+    chunks = [dag_ids[i:i + DAG_IDS_PER_REQUEST] for i in range(0, len(dag_ids), DAG_IDS_PER_REQUEST)]
+
+    if DAG_RUNS_MODE == "batch" and batch_supported.get(env_name) is not False and chunks:
+        first_chunk = iter_dag_run_pages_batch(region, env_name, chunks[0], start_time_str, end_time_str)
+        try:
+            first_page = next(first_chunk, None)
+            batch_supported[env_name] = True
+        except BatchEndpointUnsupported as e:
+            logging.info(f"Batch dagRuns/list not available in {env_name} ({e}), using per DAG requests.")
+            batch_supported[env_name] = False
+
+        if batch_supported[env_name]:
+            if first_page is not None:
+                yield first_page
+            yield from stream_pages([first_chunk] + [
+                unless_expired(iter_dag_run_pages_batch(region, env_name, chunk, start_time_str, end_time_str),
+                               chunk, deadline, pending)
+                for chunk in chunks[1:]
+            ])
+            return
+
+    yield from stream_pages(
+        unless_expired(iter_dag_run_pages(region, env_name, dag_id, start_time_str, end_time_str), [dag_id], deadline, pending)
+        for dag_id in dag_ids
+    )
+
+def iter_filtered_runs(pages, env_name):
+    for page in pages:
+        for run in page:
+            # Keep only required fields
+            yield {
+                'dag_id': run.get('dag_id'),
+                'execution_date': run.get('execution_date'),
+                'external_trigger': run.get('external_trigger'),
+                'start_date': run.get('start_date'),
+                'state': run.get('state'),
+                'environment': env_name  # Include the environment
+            }
+
+def count_pages(pages, tally):
+    # Pass pages through, counting them; every page is one request
+    for page in pages:
+        tally['pages'] += 1
+        yield page
+
+def parse_airflow_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00")) if value else None
+
+def add_sample(stats, key, value):
+    # stats[key] is [SampleCount, Sum, Minimum, Maximum]
+    sample = stats.get(key)
+    if sample is None:
+        stats[key] = [1, value, value, value]
+    else:
+        sample[0] += 1
+        sample[1] += value
+        sample[2] = min(sample[2], value)
+        sample[3] = max(sample[3], value)
+
+def aggregate_task_instances(pages):
+    # Duration and queued-to-start latency in seconds per (dag_id, task_id),
+    # as statistic sets, so memory grows with the number of tasks rather
+    # than task instances
+    durations = {}
+    queue_latencies = {}
+    for page in pages:
+        for task_instance in page:
+            key = (task_instance.get('dag_id'), task_instance.get('task_id'))
+            if task_instance.get('duration') is not None:
+                add_sample(durations, key, float(task_instance['duration']))
+            queued_when = parse_airflow_time(task_instance.get('queued_when'))
+            start_date = parse_airflow_time(task_instance.get('start_date'))
+            if queued_when and start_date:
+                add_sample(queue_latencies, key, max(0.0, (start_date - queued_when).total_seconds()))
+    return durations, queue_latencies
+
+def export_runs(runs, writer):
+    # Pass the filtered runs through, writing each one to the export
+    for run in runs:
+        writer.write(run)
+        yield run
+
+def aggregate_runs(runs):
+    # Run counts per (environment, dag_id, state)
+    counts = Counter()
+    for run in runs:
+        counts[(run['environment'], run['dag_id'], run['state'])] += 1
+    return counts
+
+def dag_run_metric_data(env_name, counts, carried=(0, 0), final=True):
+    # Success/failed per DAG that had runs, plus the environment totals.
+    # Totals carried over from earlier parts of the collection are added in,
+    # and the totals are only included once the environment is final.
+    # Returns the metric data and the (success, failed) totals.
+    dag_ids = sorted({dag_id for env, dag_id, _ in counts if env == env_name})
+    env_success_count, env_failed_count = carried
+    metric_data = []
+
+    for dag_id in dag_ids:
+        success_count = counts[(env_name, dag_id, 'success')]
+        failed_count = counts[(env_name, dag_id, 'failed')]
+        env_success_count += success_count
+        env_failed_count += failed_count
+        metric_data.extend([
+            {
+                'MetricName': 'DAGRuns.Success',
+                'Dimensions': [
+                    {'Name': 'EnvironmentName', 'Value': env_name},
+                    {'Name': 'DAG_ID', 'Value': dag_id}
+                ],
+                'Value': success_count,
+                'Unit': 'Count'
+            },
+            {
+                'MetricName': 'DAGRuns.Failed',
+                'Dimensions': [
+                    {'Name': 'EnvironmentName', 'Value': env_name},
+                    {'Name': 'DAG_ID', 'Value': dag_id}
+                ],
+                'Value': failed_count,
+                'Unit': 'Count'
+            }
+        ])
+
+    if final:
+        metric_data.extend([
+            {
+                'MetricName': 'DAGRuns.EnvironmentSuccess',
+                'Dimensions': [{'Name': 'EnvironmentName', 'Value': env_name}],
+                'Value': env_success_count,
+                'Unit': 'Count'
+            },
+            {
+                'MetricName': 'DAGRuns.EnvironmentFailed',
+                'Dimensions': [{'Name': 'EnvironmentName', 'Value': env_name}],
+                'Value': env_failed_count,
+                'Unit': 'Count'
+            }
+        ])
+
+    logging.info(f"Counted metrics for {len(dag_ids)} DAGs in {env_name}: {env_success_count} total environment successes, {env_failed_count} total environment failures.")
+    return metric_data, (env_success_count, env_failed_count)
+
+def task_instance_metric_data(env_name, durations, queue_latencies):
+    # One statistic set per task and metric, however many instances it had
+    metric_data = []
+    for metric_name, stats in (('TaskInstance.Duration', durations), ('TaskInstance.QueueLatency', queue_latencies)):
+        for (dag_id, task_id), (count, total, minimum, maximum) in sorted(stats.items()):
+            metric_data.append({
+                'MetricName': metric_name,
+                'Dimensions': [
+                    {'Name': 'EnvironmentName', 'Value': env_name},
+                    {'Name': 'DAG_ID', 'Value': dag_id},
+                    {'Name': 'TASK_ID', 'Value': task_id}
+                ],
+                'StatisticValues': {'SampleCount': count, 'Sum': total, 'Minimum': minimum, 'Maximum': maximum},
+                'Unit': 'Seconds'
+            })
+
+    return metric_data
 
-        for future in as_completed(futures):
-            dag_id = futures[future]
+def fetch_task_instances(dag_ids, region, env_name, start_time_str, end_time_str, budget, deadline=None):
+    # Task instances of the DAGs that had runs, in chunks of DAG ids on the
+    # same worker pool as the DAG runs, streamed straight into statistic sets.
+    # Returns their metric data.
+    if not dag_ids or batch_supported.get(env_name) is False:
+        return []
+    chunks = [dag_ids[i:i + DAG_IDS_PER_REQUEST] for i in range(0, len(dag_ids), DAG_IDS_PER_REQUEST)]
+    skipped = []
+    pages = stream_pages(
+        unless_expired(iter_task_instance_pages(region, env_name, chunk, start_time_str, end_time_str, budget),
+                       chunk, deadline, skipped)
+        for chunk in chunks
+    )
+    durations, queue_latencies = aggregate_task_instances(pages)
+    if budget.exhausted:
+        logging.warning(f"Task instance request budget spent in {env_name}, task metrics are incomplete.")
+    if skipped:
+        logging.warning(f"Deadline reached, task instances of {len(skipped)} DAGs in {env_name} were not queried.")
+
+    return task_instance_metric_data(env_name, durations, queue_latencies)
+
+def fetch_all_dag_runs(dags, region, env_name, start_time_str, end_time_str, deadline=None, carried=(0, 0)):
+    # fetch -> filter -> aggregate in one streaming pass into the metrics of
+    # the DAGs that were queried. Returns the metric data, the DAG ids the
+    # deadline left pending and the environment totals so far.
+    pending = []
+    tally = Counter()
+    pages = iter_dag_run_pages_for_env(dags, region, env_name, start_time_str, end_time_str, deadline, pending)
+    runs = iter_filtered_runs(count_pages(pages, tally), env_name)
+    export = None
+    if EXPORT_URI:
+        export = RecordWriter(EXPORT_URI, export_name('airflow-runs', parse_airflow_time(end_time_str), environment=env_name),
+                              RUN_EXPORT_FIELDS)
+        runs = export_runs(runs, export)
+    counts = aggregate_runs(runs)
+    if export is not None:
+        export.close()
+    logging.info(f"Counted {sum(counts.values())} DAG runs in {tally['pages']} pages in {env_name}.")
+    if pending:
+        logging.warning(f"Deadline reached, {len(pending)} DAGs in {env_name} were not queried.")
+
+    metric_data, totals = dag_run_metric_data(env_name, counts, carried=carried, final=not pending)
+
+    if TASK_INSTANCE_METRICS:
+        # No more requests than the DAG runs took, unless configured otherwise
+        budget = RequestBudget(TASK_INSTANCE_MAX_REQUESTS or tally['pages'])
+        dag_ids = sorted({dag_id for _, dag_id, _ in counts})
+        metric_data += fetch_task_instances(dag_ids, region, env_name, start_time_str, end_time_str, budget, deadline)
+    return metric_data, pending, totals
+
+def collect_environment(region, env_name, start_time_str, end_time_str, deadline=None, resume=None):
+    # resume is this environment's entry from a continuation: the DAG ids
+    # still to query and the totals so far. Returns the environment's metric
+    # data and the same entry for whatever is left, or None once the
+    # environment is done.
+    if resume and resume.get('pending') is not None:
+        dags = [{'dag_id': dag_id} for dag_id in resume['pending']]
+    else:
+        dags = get_dag_inventory(region, env_name)
+        if dags:
+            dags = active_dags(dags)
+            logging.info(f"Querying runs of {len(dags)} active DAGs in {env_name}.")
+    if dags:
+        # Fetch all DAG runs for the current environment
+        carried = tuple(resume['totals']) if resume else (0, 0)
+        metric_data, pending, totals = fetch_all_dag_runs(dags, region, env_name, start_time_str, end_time_str, deadline, carried)
+        if pending:
+            return metric_data, {'pending': pending, 'totals': list(totals)}
+        return metric_data, None
+    return [], None
+
+def collect_environments(region, env_names, start_time_str, end_time_str, deadline=None, resume=None):
+    # Collect environments concurrently, ENV_CONCURRENCY at a time, each with
+    # its own MAX_WORKERS pool. An environment that fails or runs past
+    # ENV_TIMEOUT is logged and left behind without holding up the others.
+    # Metrics are only queued from the environments that finished in time;
+    # an abandoned one's thread can't be stopped, but whatever it collects
+    # after that is dropped rather than put after the flush. Returns the
+    # failed environments and, for those the deadline cut short, what is
+    # left to do.
+    started = {}
+    unfinished = {}
+    resume = resume or {}
+
+    def run(env_name):
+        if deadline is not None and deadline.expired():
+            # Not started at all: the whole environment, inventory included
+            return [], resume.get(env_name) or {'pending': None, 'totals': [0, 0]}
+        started[env_name] = time.monotonic()
+        return collect_environment(region, env_name, start_time_str, end_time_str, deadline, resume.get(env_name))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, ENV_CONCURRENCY))
+    pending = {executor.submit(run, env_name): env_name for env_name in env_names}
+    failed = []
+
+    while pending:
+        done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            env_name = pending.pop(future)
             try:
-                dag_runs = future.result()
-                if dag_runs:
-                    logging.info(f"Fetched {len(dag_runs)} runs for DAG {dag_id}.")
-                    for run in dag_runs:
-                        run['environment'] = env_name  # Add environment name to each run
-                        # Keep only required fields
-                        run_filtered = {
-                            'dag_id': run.get('dag_id'),
-                            'execution_date': run.get('execution_date'),
-                            'external_trigger': run.get('external_trigger'),
-                            'start_date': run.get('start_date'),
-                            'state': run.get('state'),
-                            'environment': run['environment']  # Include the environment
-                        }
-                        all_dag_runs.append(run_filtered)
-
-                    # Count successful and failed DAG runs
-                    for run in dag_runs:
-                        if run.get('state') == 'success':
-                            success_count += 1
-                            env_success_count += 1
-                        elif run.get('state') == 'failed':
-                            failed_count += 1
-                            env_failed_count += 1
-
-                    # Send CloudWatch metrics for this DAG
-                    put_cloudwatch_metrics(success_count, failed_count, dag_id, env_name, env_success_count, env_failed_count)
+                metric_data, left = future.result()
             except Exception as e:
-                logging.error(f"Error fetching DAG runs for {dag_id}: {str(e)}")
+                logging.error(f"Error collecting environment {env_name}: {str(e)}")
+                failed.append(env_name)
+                continue
+            if left is not None:
+                unfinished[env_name] = left
+            try:
+                publisher.put('AmazonMWAA', metric_data)
+                logging.info(f"Queued {len(metric_data)} CloudWatch metrics for {env_name}.")
+            except Exception as e:
+                logging.error(f"Failed to put CloudWatch metrics for {env_name}: {str(e)}")
+
+        now = time.monotonic()
+        for future, env_name in list(pending.items()):
+            if env_name in started and now - started[env_name] > ENV_TIMEOUT:
+                logging.error(f"Environment {env_name} did not finish within {ENV_TIMEOUT} seconds, skipping it.")
+                del pending[future]
+                failed.append(env_name)
+
+    executor.shutdown(wait=False, cancel_futures=True)
+    return failed, unfinished
 
-    return all_dag_runs
+def new_cursor(window, part):
+    # A collection of every environment in the window, part collections done
+    return {'window': window, 'environments': {env_name: None for env_name in ENV_NAMES}, 'part': part}
 
+def take_saved_continuation():
+    # A continuation left by an earlier tick that couldn't re-invoke itself
+    if inventory_store is None:
+        return None
+    continuation = inventory_store.get_json("continuation/airflow.json")
+    if continuation is not None:
+        inventory_store.delete("continuation/airflow.json")
+    return continuation
+
+def save_continuation(payload):
+    inventory_store.put_json("continuation/airflow.json", payload[CONTINUATION_EVENT_KEY])
+
+@instrumented_handler('airflow-dag-run-metrics', 'AmazonMWAA', publisher)
 def lambda_handler(event, context):
     logging.basicConfig(level=logging.INFO)
 
     region = REGION
-    all_dag_runs = []
+    deadline = Deadline(context)
 
-    # Iterate through each environment
-    for env_name in ENV_NAMES:
-        dags = list_dags(region, env_name)
-        if dags:
-            start_time = datetime.now() - timedelta(minutes=30)  # Adjust for last 30 mins
-            end_time = datetime.now()
-            start_time_str = start_time.isoformat() + "Z"  # Convert to ISO 8601 format
-            end_time_str = end_time.isoformat() + "Z"  # Convert to ISO 8601 format
-            
-            # Fetch all DAG runs for the current environment
-            dag_runs = fetch_all_dag_runs(dags, region, env_name, start_time_str, end_time_str)
-            all_dag_runs.extend(dag_runs)
+    # The rest of a collection that ran out of time in an earlier invocation.
+    # A scheduled tick collects its own window, after finishing any
+    # collection an earlier tick had to save.
+    continuation = event.get(CONTINUATION_EVENT_KEY)
+    queued = []
+    if continuation is None:
+        start_time = datetime.now() - timedelta(minutes=30)  # Adjust for last 30 mins
+        end_time = datetime.now()
+        start_time_str = start_time.isoformat() + "Z"  # Convert to ISO 8601 format
+        end_time_str = end_time.isoformat() + "Z"  # Convert to ISO 8601 format
+        continuation = take_saved_continuation()
+        if continuation:
+            logging.info("Finishing a saved DAG run collection before this tick's window.")
+            queued = [[start_time_str, end_time_str]]
+        else:
+            continuation = new_cursor([start_time_str, end_time_str], 0)
+    queued = continuation.get('queued', []) + queued
+    if len(queued) > MAX_QUEUED_WINDOWS:
+        logging.error(f"{len(queued)} DAG run windows waiting, dropping the oldest {len(queued) - MAX_QUEUED_WINDOWS}.")
+        queued = queued[-MAX_QUEUED_WINDOWS:]
+
+    failed = []
+    while True:
+        start_time_str, end_time_str = continuation['window']
+        resume = continuation['environments']
+        part = continuation['part'] + 1
+        if part > 1:
+            logging.info(f"Continuing DAG run collection, part {part}, for {list(resume)}.")
+
+        window_failed, unfinished = collect_environments(region, list(resume), start_time_str, end_time_str, deadline, resume)
+        failed += window_failed
+
+        # Send all environments' CloudWatch metrics in as few calls as possible
+        publisher.flush()
+
+        if unfinished and part < MAX_CONTINUATIONS:
+            continuation = {'window': [start_time_str, end_time_str], 'environments': unfinished, 'part': part}
+            break
+        elif unfinished:
+            logging.error(f"DAG run collection still unfinished after {part} invocations, giving up on {list(unfinished)}.")
+
+        continuation = new_cursor(queued.pop(0), 0) if queued else None
+        if continuation is None or deadline.expired():
+            break
+
+    if continuation is not None:
+        continuation['queued'] = queued
+        hand_off(context, {CONTINUATION_EVENT_KEY: continuation}, save=save_continuation if inventory_store is not None else None)
 
     return {
         'statusCode': 200,
-        'body': json.dumps('DAG runs processed successfully!')
+        'body': json.dumps('DAG runs processed successfully!' if not failed else f'DAG runs processed, failed environments: {failed}')
     }
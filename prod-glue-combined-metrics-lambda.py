@@ -0,0 +1,107 @@
+import datetime
+import json
+import logging
+
+from bootstrap import lazy_client
+from glue_collector import (CLOUDWATCH_NAMESPACE, DpuCost, FleetTotals, JobStatusCounts, RunDistribution, RunExport,
+                            status_count_window)
+from glue_events import COLLECT_MODE, is_state_change_batch, record_state_changes, replay_recorded_runs
+from glue_resume import CONTINUATION_EVENT_KEY, collect
+from glue_shards import SHARD_EVENT_KEY, SHARDS, collect_shard, fan_out
+from glue_state import open_state_store
+from instrumentation import instrumented_handler
+from metric_publisher import create_publisher
+from run_export import EXPORT_URI
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# AWS SDK clients, created on first use
+glue_client = lazy_client('glue')
+cloudwatch_client = lazy_client('cloudwatch')
+publisher = create_publisher(cloudwatch_client)
+
+# Incremental scan state, only when GLUE_STATE_STORE is set
+state_store = open_state_store()
+
+# Runs recorded from Glue Job State Change events are kept in the state
+# store; without one the tick would replay nothing and publish zeros
+if COLLECT_MODE == 'events' and state_store is None:
+    raise ValueError("GLUE_COLLECT_MODE=events needs GLUE_STATE_STORE")
+
+COLLECTOR = 'glue-combined-metrics'
+
+@instrumented_handler(COLLECTOR, CLOUDWATCH_NAMESPACE, publisher)
+def lambda_handler(event, context):
+    # A shard worker invoked by the coordinator only returns its partials
+    if SHARD_EVENT_KEY in event:
+        return collect_shard(event[SHARD_EVENT_KEY], glue_client, state_store)
+
+    # A batch of Glue Job State Change events is only recorded; the
+    # scheduled tick publishes from the recorded runs
+    if is_state_change_batch(event):
+        if state_store is None:
+            raise ValueError("Glue Job State Change events need GLUE_STATE_STORE to be recorded")
+        failed = record_state_changes(glue_client, state_store, event)
+        if failed and 'Records' not in event:
+            # Straight from EventBridge, which ignores batchItemFailures; fail
+            # the invocation so Lambda's async retries and DLQ apply
+            raise RuntimeError(f"Failed to record Glue Job State Change event {failed[0]}")
+        return {'batchItemFailures': [{'itemIdentifier': item_id} for item_id in failed]}
+
+    # The rest of a polling scan that ran out of time in an earlier invocation
+    continuation = event.get(CONTINUATION_EVENT_KEY)
+    if continuation is not None:
+        collection = collect(COLLECTOR, glue_client, None, publish_metrics, context=context,
+                             state_store=state_store, continuation=continuation)
+        return {
+            'statusCode': 200,
+            'body': json.dumps(dict(collection.published, runs=collection.run_count, finished=collection.finished))
+        }
+
+    # One pass over the runs produces the JobStatusCount, Glue.*, DPU_* and JobRun* families
+    current_time = datetime.datetime.now(datetime.timezone.utc)
+    one_hour_ago = current_time - datetime.timedelta(hours=1)
+
+    # JobStatusCount keeps its rounded half-hour window
+    status_start_time, status_end_time = status_count_window(current_time)
+
+    status_counts = JobStatusCounts(status_start_time, status_end_time)
+    totals = FleetTotals(one_hour_ago, current_time)
+    dpu_cost = DpuCost(one_hour_ago, current_time)
+    distribution = RunDistribution(one_hour_ago, current_time)
+
+    aggregators = [status_counts, totals, dpu_cost, distribution]
+    if EXPORT_URI:
+        aggregators.append(RunExport(one_hour_ago, current_time))  # Per-run records, from the same scan
+    failed_shards = []
+    finished = True
+    if COLLECT_MODE == 'events':
+        run_count = replay_recorded_runs(glue_client, state_store, aggregators)
+        stats = publish_metrics(aggregators, finished)
+    elif SHARDS > 1:
+        run_count, failed_shards = fan_out(glue_client, aggregators, function_name=getattr(context, 'function_name', None))
+        # Fleet totals over only part of the fleet would look like real data
+        finished = not failed_shards
+        stats = publish_metrics(aggregators, finished)
+    else:
+        # Publishes what it has before the deadline and hands on the rest,
+        # after finishing any scan an earlier tick had to save
+        collection = collect(COLLECTOR, glue_client, aggregators, publish_metrics, context=context,
+                             state_store=state_store)
+        run_count, finished, stats = collection.run_count, collection.finished, collection.published
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(dict(stats, runs=run_count, failed_shards=failed_shards, finished=finished))
+    }
+
+def publish_metrics(aggregators, finished):
+    # Glue.* totals are only published once every job has been scanned
+    status_counts, totals, dpu_cost, distribution = aggregators[:4]  # A RunExport may follow
+    publisher.put(CLOUDWATCH_NAMESPACE, status_counts.metric_data())
+    if finished:
+        publisher.put(CLOUDWATCH_NAMESPACE, totals.metric_data(timestamp=totals.end_time))
+    publisher.put(CLOUDWATCH_NAMESPACE, dpu_cost.metric_data())
+    publisher.put(CLOUDWATCH_NAMESPACE, distribution.metric_data())
+    return publisher.flush()
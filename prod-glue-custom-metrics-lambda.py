@@ -1,131 +1,67 @@
-import boto3
 import datetime
 import json
-import pytz
 
-# Initialize AWS SDK clients
-glue_client = boto3.client('glue')
-cloudwatch_client = boto3.client('cloudwatch')
+from bootstrap import lazy_client
+from glue_backfill import backfill
+from glue_collector import CLOUDWATCH_NAMESPACE, JobStatusCounts, status_count_window
+from glue_resume import CONTINUATION_EVENT_KEY, collect
+from glue_state import open_state_store
+from instrumentation import instrumented_handler
+from metric_publisher import create_publisher
 
-# Define the CloudWatch namespace
-CLOUDWATCH_NAMESPACE = 'GlueCM'
+# AWS SDK clients, created on first use
+glue_client = lazy_client('glue')
+cloudwatch_client = lazy_client('cloudwatch')
+publisher = create_publisher(cloudwatch_client)
 
-def round_to_nearest_half_hour(dt):
-    # Round to the nearest half-hour (00 or 30)
-    minute = dt.minute
-    if minute < 15:
-        dt = dt.replace(minute=0, second=0, microsecond=0)
-    elif minute < 45:
-        dt = dt.replace(minute=30, second=0, microsecond=0)
-    else:
-        dt = dt.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
-    return dt
+# Incremental scan state, only when GLUE_STATE_STORE is set
+state_store = open_state_store()
 
+COLLECTOR = 'glue-custom-metrics'
+
+@instrumented_handler(COLLECTOR, CLOUDWATCH_NAMESPACE, publisher)
 def lambda_handler(event, context):
-    # Get the current time in UTC
-    utc_tz = pytz.utc
-    current_time = datetime.datetime.now(utc_tz)
+    # {"backfill": {"start": ..., "end": ..., "bucket_minutes": 60}} recomputes
+    # a past range instead of the current window
+    if 'backfill' in event:
+        result = backfill(glue_client, publisher, CLOUDWATCH_NAMESPACE, event['backfill'], state_store=state_store)
+        return {
+            'statusCode': 200,
+            'body': json.dumps(result)
+        }
 
-    # Round the current time to the nearest half-hour
-    end_time = round_to_nearest_half_hour(current_time)
-    start_time = end_time - datetime.timedelta(minutes=60)  # One hour before the rounded time
+    # The rest of a collection that ran out of time in an earlier invocation.
+    # A scheduled tick collects its own window, after finishing any
+    # collection an earlier tick had to save.
+    continuation = event.get(CONTINUATION_EVENT_KEY)
+    aggregators = None
 
-    # Print the rounded-off start and end times
-    print(f"Current Time: {current_time}")
-    print(f"Rounded Start Time: {start_time}")
-    print(f"Rounded End Time: {end_time}")
+    if continuation is None:
+        # Get the current time in UTC
+        current_time = datetime.datetime.now(datetime.timezone.utc)
 
-    # Initialize a dictionary to hold counts for each job
-    job_counts = {}
+        # Round the current time to the nearest half-hour
+        start_time, end_time = status_count_window(current_time)
 
-    # List all Glue jobs
-    glue_jobs = glue_client.get_jobs()
+        # Print the rounded-off start and end times
+        print(f"Current Time: {current_time}")
+        print(f"Rounded Start Time: {start_time}")
+        print(f"Rounded End Time: {end_time}")
 
-    # Iterate through each job to get the job runs
-    for job in glue_jobs['Jobs']:
-        job_name = job['Name']
-        
-        # Initialize counts for the current job
-        job_counts[job_name] = {
-            'Running': 0,
-            'Succeeded': 0,
-            'Failed': 0
-        }
-        
-        # Get job runs for the last rounded hour
-        job_runs = glue_client.get_job_runs(JobName=job_name)
-        
-        for run in job_runs['JobRuns']:
-            # Ensure the StartedOn time is timezone-aware
-            if 'StartedOn' in run:
-                started_on = run['StartedOn'].astimezone(utc_tz)  # Convert to UTC timezone if needed
-                
-                # Check if the job run was started within the rounded time frame
-                if start_time <= started_on <= end_time:
-                    status = run['JobRunState']
-                    if status == 'RUNNING':
-                        job_counts[job_name]['Running'] += 1
-                    elif status == 'SUCCEEDED':
-                        job_counts[job_name]['Succeeded'] += 1
-                    elif status == 'FAILED':
-                        job_counts[job_name]['Failed'] += 1
+        # Count job runs for each job in the rounded hour
+        aggregators = [JobStatusCounts(start_time, end_time)]
 
-    # Prepare CloudWatch metrics
-    metric_data = []
-    for job_name, counts in job_counts.items():
-        metric_data.append({
-            'MetricName': 'JobStatusCount',
-            'Value': counts['Running'],
-            'Unit': 'Count',
-            'Dimensions': [
-                {
-                    'Name': 'JobName',
-                    'Value': job_name
-                },  
-                {
-                    'Name': 'Status',
-                    'Value': 'Running'
-                }
-            ]
-        })
-        metric_data.append({
-            'MetricName': 'JobStatusCount',
-            'Value': counts['Succeeded'],
-            'Unit': 'Count',
-            'Dimensions': [
-                {
-                    'Name': 'JobName',
-                    'Value': job_name
-                },
-                {
-                    'Name': 'Status',
-                    'Value': 'Succeeded'
-                }
-            ]
-        })
-        metric_data.append({
-            'MetricName': 'JobStatusCount',
-            'Value': counts['Failed'],
-            'Unit': 'Count',
-            'Dimensions': [
-                {
-                    'Name': 'JobName',
-                    'Value': job_name
-                },
-                {
-                    'Name': 'Status',
-                    'Value': 'Failed'
-                }
-            ]
-        })
+    collection = collect(COLLECTOR, glue_client, aggregators, publish_metrics, context=context,
+                         state_store=state_store, continuation=continuation)
+    status_counts = collection.aggregators[0]
 
-    # Send metrics to CloudWatch
-    cloudwatch_client.put_metric_data(
-        Namespace=CLOUDWATCH_NAMESPACE,
-        MetricData=metric_data
-    )
-    
     return {
         'statusCode': 200,
-        'body': json.dumps(job_counts)  # Return the counts for each job
+        'body': json.dumps(status_counts.job_counts)  # Return the counts for each job
     }
+
+def publish_metrics(aggregators, finished):
+    # Send metrics to CloudWatch, for the jobs scanned so far
+    status_counts, = aggregators
+    publisher.put(CLOUDWATCH_NAMESPACE, status_counts.metric_data())
+    publisher.flush()
@@ -0,0 +1,219 @@
+import csv
+import gzip
+import io
+import logging
+import os
+import uuid
+
+logger = logging.getLogger()
+
+# Per-run records are exported as they are collected when RUN_EXPORT_URI (a
+# local directory or s3://bucket/prefix) is set
+EXPORT_URI = os.getenv('RUN_EXPORT_URI')
+EXPORT_FORMAT = os.getenv('RUN_EXPORT_FORMAT', 'auto')  # csv, parquet, or auto: parquet when pyarrow is installed
+CHUNK_ROWS = int(os.getenv('RUN_EXPORT_CHUNK_ROWS', '10000'))  # Records held before a chunk is written
+S3_PART_BYTES = 8 * 1024 * 1024  # Multipart upload part size; S3's minimum is 5 MiB
+
+
+def _pyarrow():
+    # pyarrow is optional and only imported when an export is written
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+class S3UploadFile:
+    # Write-only file object that streams to one S3 (or S3 compatible)
+    # object with a multipart upload, holding at most one part in memory.
+    # Files smaller than a part are sent with a single put_object.
+
+    def __init__(self, bucket, key, s3_client=None, part_bytes=S3_PART_BYTES):
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = s3_client
+        self.part_bytes = part_bytes
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+
+    def _client(self):
+        if self.s3_client is None:
+            from bootstrap import get_client
+            self.s3_client = get_client('s3')
+        return self.s3_client
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_bytes:
+            self._upload_part(bytes(self.buffer[:self.part_bytes]))
+            del self.buffer[:self.part_bytes]
+        return len(data)
+
+    def _upload_part(self, data):
+        client = self._client()
+        if self.upload_id is None:
+            self.upload_id = client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                      PartNumber=part_number, Body=data)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        client = self._client()
+        if self.upload_id is None:
+            client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            return
+
+        try:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                             MultipartUpload={'Parts': self.parts})
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        self.closed = True
+        if self.upload_id is not None:
+            self._client().abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+
+def open_target(uri, name):
+    # (file object, location) for name under a local directory or
+    # s3://bucket/prefix
+    if uri.startswith('s3://'):
+        bucket, _, prefix = uri[len('s3://'):].partition('/')
+        key = f"{prefix.strip('/')}/{name}" if prefix.strip('/') else name
+        return S3UploadFile(bucket, key), f"s3://{bucket}/{key}"
+    if uri.startswith('file://'):
+        uri = uri[len('file://'):]
+    path = os.path.join(uri, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, 'wb'), path
+
+
+def export_name(dataset, end_time, **partitions):
+    # <dataset>/<partition>=<value>/.../date=YYYY-MM-DD/HHMM-<unique>, so
+    # every writer (shard, continuation part, environment) gets its own file
+    parts = [dataset] + [f"{key}={value}" for key, value in partitions.items()]
+    parts += [f"date={end_time:%Y-%m-%d}", f"{end_time:%H%M}-{uuid.uuid4().hex[:12]}"]
+    return '/'.join(parts)
+
+
+class RecordWriter:
+    # Streams records (dicts) to one file in chunks of chunk_rows: gzip CSV,
+    # or Parquet with one row group per chunk. Memory is one chunk plus the
+    # target's buffer however many records there are. fields is a list of
+    # (name, kind), kind being string, timestamp, int, float or bool. The
+    # file is only created once there is a record to write. An export that
+    # fails is logged and abandoned; it never stops the metrics.
+    PARQUET_TYPES = {
+        'string': lambda pa: pa.string(),
+        'timestamp': lambda pa: pa.timestamp('us', tz='UTC'),
+        'int': lambda pa: pa.int64(),
+        'float': lambda pa: pa.float64(),
+        'bool': lambda pa: pa.bool_(),
+    }
+
+    def __init__(self, uri, name, fields, export_format=EXPORT_FORMAT, chunk_rows=CHUNK_ROWS):
+        self.uri = uri
+        self.fields = fields
+        self.chunk_rows = chunk_rows
+        self.pa = _pyarrow() if export_format in ('auto', 'parquet') else None
+        if export_format == 'parquet' and self.pa is None:
+            logger.warning("pyarrow is not installed, exporting gzip CSV instead of Parquet.")
+        self.name = f"{name}.parquet" if self.pa is not None else f"{name}.csv.gz"
+        self.chunk = []
+        self.file = None
+        self.location = None
+        self.rows = 0
+        self.failed = False
+
+    def write(self, record):
+        if self.failed:
+            return
+        self.chunk.append(record)
+        if len(self.chunk) >= self.chunk_rows:
+            self._write_chunk()
+
+    def _open(self):
+        self.file, self.location = open_target(self.uri, self.name)
+        field_names = [name for name, _ in self.fields]
+        if self.pa is not None:
+            self.schema = self.pa.schema([(name, self.PARQUET_TYPES[kind](self.pa)) for name, kind in self.fields])
+            self.parquet = self.pa.parquet.ParquetWriter(self.file, self.schema)
+        else:
+            self.text = io.TextIOWrapper(gzip.GzipFile(fileobj=self.file, mode='wb'), encoding='utf-8', newline='')
+            self.csv = csv.writer(self.text)
+            self.csv.writerow(field_names)
+
+    def _write_chunk(self):
+        if not self.chunk or self.failed:
+            return
+        try:
+            if self.file is None:
+                self._open()
+            if self.pa is not None:
+                self.parquet.write_table(self.pa.Table.from_pylist(self.chunk, schema=self.schema))
+            else:
+                self.csv.writerows([[_csv_value(record.get(name)) for name, _ in self.fields] for record in self.chunk])
+            self.rows += len(self.chunk)
+        except Exception as e:
+            logger.error(f"Failed to export records to {self.location or self.name}: {str(e)}")
+            self._abandon()
+        self.chunk = []
+
+    def _abandon(self):
+        # Don't leave a half written export behind
+        self.failed = True
+        try:
+            if isinstance(self.file, S3UploadFile):
+                self.file.abort()
+            elif self.file is not None:
+                self.file.close()
+                os.remove(self.location)
+        except Exception as e:
+            logger.error(f"Failed to clean up export {self.location}: {str(e)}")
+
+    def close(self):
+        # Writes what is left and finishes the file. Returns its location,
+        # or None when there were no records or the export failed.
+        self._write_chunk()
+        if self.file is None or self.failed:
+            return None
+        try:
+            if self.pa is not None:
+                self.parquet.close()
+            else:
+                self.text.close()  # Writes the gzip trailer, leaves self.file open
+            self.file.close()
+        except Exception as e:
+            logger.error(f"Failed to finish export {self.location}: {str(e)}")
+            self._abandon()
+            return None
+        logger.info(f"Exported {self.rows} records to {self.location}.")
+        return self.location
+
+
+def _csv_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value